@@ -0,0 +1,335 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import itertools
+import traceback
+import multiprocessing
+from contextlib import redirect_stdout
+try:
+    import resource
+except ImportError: #not available on Windows
+    resource = None
+import numpy as np
+
+from hmm import HMM, DECODERS
+from utils import *
+
+
+
+#the synthetic corpus is made of these letters and tags (written as escapes
+#so the order of the combining characters can't be changed by an editor)
+LETTERS = [chr(point) for point in range(0x627, 0x63b)] + [chr(point) for point in range(0x641, 0x64b)]
+SHADDA = '\u0651'
+VOWELS = ['\u064b', '\u064c', '\u064d', '\u064e', '\u064f', '\u0650', '\u0652']
+TAGS = VOWELS + [SHADDA] + [SHADDA+vowel for vowel in VOWELS] + ['']
+#measured in words per second (the higher the better), the rest of the
+#measurements (seconds and megabytes) are the lower the better
+SPEED_METRICS = ('train', 'diacritized_word', 'diacritized_word_cached',
+                 'diacritize_batch', 'diacritized_data', 'evaluate')
+COST_METRICS = ('load_pickle_seconds', 'load_binary_seconds',
+                'load_pickle_rss_mb', 'load_binary_rss_mb', 'peak_rss_mb')
+
+
+
+def make_corpus(data_dir, num_words=10**6, vocab_size=20000, num_files=4, test_ratio=0.1, seed=0):
+    """
+    This function writes a synthetic diacritized corpus into 'data_dir' in
+    the same layout as the preprocessed data (see preprocess_data.py):
+    'num_files' training files, one gold file and its undiacritized copy.
+    Words are drawn from a vocabulary of 'vocab_size' random words using
+    Zipf's law (like real text, a few words make up most of it) and every
+    letter has a few preferred tags, so the corpus can be learned. The
+    same arguments always give the same corpus.
+    It returns the number of training words and test words.
+    """
+    rng = random.Random(seed)
+    preferred = {letter: rng.sample(TAGS, 3) for letter in LETTERS}
+    def make_word():
+        letters = rng.choices(LETTERS, k=rng.randint(2, 8))
+        return ''.join([letter + rng.choice(preferred[letter] if rng.random() < 0.8 else TAGS)
+                        for letter in letters])
+    vocab = [make_word() for _ in range(vocab_size)]
+    cum_weights = list(itertools.accumulate(1./rank for rank in range(1, vocab_size+1)))
+    def make_sentences(total):
+        sentences = []
+        while total > 0:
+            length = min(rng.randint(1, 20), total)
+            sentences.append(rng.choices(vocab, cum_weights=cum_weights, k=length))
+            total -= length
+        return sentences
+
+    num_test = int(num_words * test_ratio)
+    num_train = num_words - num_test
+    train_dir = os.path.join(data_dir, PREPROCESSED_DIR, 'train')
+    gold_dir = os.path.join(data_dir, PREPROCESSED_DIR, 'test', 'gold')
+    test_dir = os.path.join(data_dir, PREPROCESSED_DIR, 'test', 'test')
+    for directory in [train_dir, gold_dir, test_dir]:
+        create_dir(directory)
+    for idx in range(num_files):
+        size = num_train // num_files + (idx < num_train % num_files)
+        _write_sentences(os.path.join(train_dir, str(idx+1)), make_sentences(size))
+    sentences = make_sentences(num_test)
+    _write_sentences(os.path.join(gold_dir, '1'), sentences)
+    _write_sentences(os.path.join(test_dir, '1'),
+                     [[clean_word(word) for word in sentence] for sentence in sentences])
+    return num_train, num_test
+
+
+def _write_sentences(path, sentences):
+    """write one word per line, sentences are separated by an empty line"""
+    with open_text(path, 'w') as fout:
+        for sentence in sentences:
+            fout.write('\n'.join(sentence) + '\n\n')
+
+
+def _count_words(directory):
+    """the number of words (non-empty lines) in all the files of a directory"""
+    total = 0
+    for filename in os.listdir(directory):
+        with open_text(os.path.join(directory, filename)) as fin:
+            total += sum(1 for line in fin if line.strip())
+    return total
+
+
+def _peak_rss_mb():
+    """the peak resident memory of this process in megabytes (None if unknown)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #kilobytes on Linux, bytes on macOS
+    return peak / (1024.**2 if sys.platform == 'darwin' else 1024.)
+
+
+def _speed(func, num_words):
+    """call func() and return the number of words it handled per second"""
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    return num_words/seconds if seconds else float('inf')
+
+
+def load_model(path):
+    """
+    This function loads the model saved at 'path' and diacritizes one word,
+    then it returns the time it took (in seconds) and the peak memory of
+    the process. It's run in a new process, so nothing else is counted.
+    """
+    start = time.perf_counter()
+    model = HMM.load(path, cache_size=0)
+    model.diacritized_word(LETTERS[0] + LETTERS[1])
+    return time.perf_counter() - start, _peak_rss_mb()
+
+
+def benchmark_model(job):
+    """
+    This function trains an n-gram model on the corpus of 'work_dir' (see
+    make_corpus()) and measures it. It takes a tuple of (work_dir, n, workers)
+    and it's run in a new process, so the peak memory is of this model only.
+    It returns a dictionary of:
+    -> words per second of: train(), diacritized_word() with and without the
+       cache, diacritize_batch(), diacritized_data() and evaluate().
+    -> DER and WER of the model on the test data.
+    -> the size of the saved model (pickle and binary) and its number of contexts.
+    -> peak_rss_mb: the peak memory of the whole run.
+    """
+    work_dir, n, workers = job
+    os.chdir(work_dir)
+    results = {'N': n}
+    with redirect_stdout(sys.stderr):
+        model = HMM(n, cache_size=0)
+        if os.path.exists(model.model_path):
+            #start from scratch, otherwise the files would be skipped
+            os.remove(model.model_path)
+            model = HMM(n, cache_size=0)
+        num_train = _count_words(model.train_dir)
+        num_test = _count_words(model.test_dir)
+        results['train'] = _speed(lambda: model.train(workers), num_train)
+        binary_path = str(n) + 'gram_CharModel.bin'
+        model.save(binary_path)
+        results['contexts'] = len(model.character_ngram)
+        results['pickle_mb'] = os.path.getsize(model.model_path) / 1024.**2
+        results['binary_mb'] = os.path.getsize(binary_path) / 1024.**2
+
+        words = []
+        for filename in os.listdir(model.test_dir):
+            with open_text(os.path.join(model.test_dir, filename)) as fin:
+                words.extend(line.strip() for line in fin if line.strip())
+        results['diacritized_word'] = _speed(lambda: [model.diacritized_word(word) for word in words], len(words))
+        cached = HMM.load(binary_path)
+        #warm up first so that only the cache is timed (not the lazy loading
+        #of the memory-mapped model nor the first misses)
+        for word in words:
+            cached.diacritized_word(word)
+        results['diacritized_word_cached'] = _speed(lambda: [cached.diacritized_word(word) for word in words], len(words))
+        results['diacritize_batch'] = _speed(lambda: model.diacritize_batch(words), len(words))
+        results['diacritized_data'] = _speed(model.diacritized_data, num_test)
+        evaluation = {}
+        results['evaluate'] = _speed(lambda: evaluation.update(model.evaluate(workers=workers)), num_test)
+        results['DER'] = evaluation['DER']
+        results['WER'] = evaluation['WER']
+    results['peak_rss_mb'] = _peak_rss_mb()
+    return results
+
+
+def _send_result(queue, func, args):
+    """call func(*args) and put its result (or the error) into 'queue'"""
+    try:
+        queue.put((func(*args), None))
+    except BaseException:
+        queue.put((None, traceback.format_exc()))
+
+
+def _run_in_process(context, func, *args):
+    """
+    This function calls func(*args) in a new process and returns its
+    result. Unlike the workers of a Pool, this process isn't daemonic, so
+    func() can start its own processes (train() and evaluate() do).
+    """
+    queue = context.Queue()
+    process = context.Process(target=_send_result, args=(queue, func, args))
+    process.start()
+    try:
+        result, error = queue.get()
+    finally:
+        process.join()
+    if error is not None:
+        raise RuntimeError("%s failed in its process:\n%s" % (func.__name__, error))
+    return result
+
+
+def run_benchmarks(ns=(2, 3), num_words=10**6, seed=0, workers=1, work_dir=None):
+    """
+    This function generates a synthetic corpus of 'num_words' words (see
+    make_corpus()) then it benchmarks a model of every N in 'ns' (see
+    benchmark_model()), each one in a new process. The load time and memory
+    of the saved models (pickle and binary) are measured in new processes
+    too. It returns a JSON-ready dictionary of the configuration, the
+    environment and the results of every N.
+    The corpus and the models are written into 'work_dir' (a temporary
+    directory by default).
+    """
+    work_dir = os.path.abspath(work_dir or tempfile.mkdtemp(prefix='tashkeel_benchmark_'))
+    num_train, num_test = make_corpus(work_dir, num_words, seed=seed)
+    report = {'config': {'ns': list(ns), 'num_words': num_words, 'train_words': num_train,
+                         'test_words': num_test, 'seed': seed, 'workers': workers, 'work_dir': work_dir},
+              'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                              'platform': platform.platform(), 'cpus': os.cpu_count()},
+              'results': {}}
+    #'spawn' gives every run a fresh process (forked ones start with our memory)
+    context = multiprocessing.get_context('spawn')
+    for n in ns:
+        print("----- Benchmarking the %dgram model ------" % n, file=sys.stderr)
+        results = _run_in_process(context, benchmark_model, (work_dir, n, workers))
+        for kind, extension in [('pickle', '.pickle'), ('binary', '.bin')]:
+            path = os.path.join(work_dir, str(n) + 'gram_CharModel' + extension)
+            seconds, rss = _run_in_process(context, load_model, path)
+            results['load_%s_seconds' % kind] = seconds
+            results['load_%s_rss_mb' % kind] = rss
+        report['results'][str(n)] = results
+    return report
+
+
+def compare(report, baseline, tolerance=0.1):
+    """
+    This function compares the results of run_benchmarks() with older ones
+    ('baseline') and returns a list of the regressions: speeds that dropped
+    or times/memory that grew by more than 'tolerance' (a ratio).
+    Results that aren't in both of them are skipped.
+    """
+    regressions = []
+    for n, results in report['results'].items():
+        old_results = baseline.get('results', {}).get(n, {})
+        for metric in SPEED_METRICS + COST_METRICS:
+            new, old = results.get(metric), old_results.get(metric)
+            if new is None or old is None:
+                continue
+            if metric in SPEED_METRICS:
+                regressed = new < old * (1 - tolerance)
+            else:
+                regressed = new > old * (1 + tolerance)
+            if regressed:
+                regressions.append('%sgram %s: %.4g -> %.4g' % (n, metric, old, new))
+    return regressions
+
+
+def benchmark_decoders(model_path, gold_path, decoders=DECODERS, max_words=100000, beam_size=4):
+    """
+    This function compares the decoders (see HMM.diacritized_word()) on
+    the first 'max_words' words of a gold file (a diacritized file in the
+    preprocessed format). It returns a dictionary: decoder -> results
+    where the results are the number of words diacritized per second and
+    the accuracy (character-wise and word-wise).
+    The cache is disabled, so every word is really decoded.
+    """
+    gold_words = []
+    with open_text(gold_path) as fin:
+        for line in fin:
+            line = line.strip()
+            if len(line) >= 2:
+                gold_words.append(line)
+            if len(gold_words) >= max_words:
+                break
+    words = [clean_word(word) for word in gold_words]
+    results = {}
+    for decoder in decoders:
+        model = HMM.load(model_path, cache_size=0, decoder=decoder, beam_size=beam_size)
+        start = time.perf_counter()
+        predicted_words = model.diacritize_batch(words)
+        seconds = time.perf_counter() - start
+        correct_chars = total_chars = correct_words = 0
+        for gold_word, predicted_word in zip(gold_words, predicted_words):
+            _, gold_tags = split_word(gold_word)
+            _, predicted_tags = split_word(predicted_word)
+            if len(gold_tags) != len(predicted_tags): #a single character
+                continue
+            correct = sum(gold_tag == predicted_tag for gold_tag, predicted_tag in zip(gold_tags, predicted_tags))
+            correct_chars += correct
+            total_chars += len(gold_tags)
+            correct_words += correct == len(gold_tags)
+        results[decoder] = {'words_per_sec': len(words)/seconds if seconds else float('inf'),
+                            'char_accuracy': correct_chars/total_chars if total_chars else 0.,
+                            'word_accuracy': correct_words/len(words) if words else 0.}
+    return results
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the models and the decoders.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    suite = commands.add_parser('suite', help="train and measure models on a synthetic corpus")
+    suite.add_argument('--n', type=int, nargs='+', default=[2, 3], help="the orders of the models")
+    suite.add_argument('--words', type=int, default=10**6, help="number of words of the corpus")
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--workers', type=int, default=1)
+    suite.add_argument('--work-dir', help="where the corpus and the models are written")
+    suite.add_argument('--output', default='-', help="where the JSON results are written (stdout by default)")
+    suite.add_argument('--baseline', help="JSON results to compare with, exits with 1 on regressions")
+    suite.add_argument('--tolerance', type=float, default=0.1, help="allowed regression ratio")
+    decoders = commands.add_parser('decoders', help="compare the decoders of a trained model")
+    decoders.add_argument('model', help="path of the trained model (pickle or binary)")
+    decoders.add_argument('gold', help="diacritized file (one word per line)")
+    decoders.add_argument('--max-words', type=int, default=100000)
+    decoders.add_argument('--beam-size', type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == 'decoders':
+        results = benchmark_decoders(args.model, args.gold, max_words=args.max_words, beam_size=args.beam_size)
+        for decoder, result in results.items():
+            print('%-8s %10.0f words/sec   char accuracy: %f   word accuracy: %f'
+                  %(decoder, result['words_per_sec'], result['char_accuracy'], result['word_accuracy']))
+    else:
+        report = run_benchmarks(args.n, args.words, args.seed, args.workers, args.work_dir)
+        with open_text(args.output, 'w') as fout:
+            fout.write(json.dumps(report, indent=2) + '\n')
+        if args.baseline:
+            with open_text(args.baseline) as fin:
+                regressions = compare(report, json.load(fin), args.tolerance)
+            for regression in regressions:
+                print("REGRESSION:", regression, file=sys.stderr)
+            sys.exit(1 if regressions else 0)
@@ -0,0 +1,120 @@
+import numpy as np
+
+
+
+#tags that were never seen get this probability instead of zero
+MIN_PROBABILITY = 1e-12
+
+
+
+class Decoder(object):
+    def __init__(self, table, transition_weight=1., smoothing=1.):
+        """
+        This class decodes the best sequence of tags of a word using both
+        the character n-gram counts and the tag transitions of 'table'
+        (a frozen NgramTable). The score of tag t at character i is:
+            log P(t | context_i) + w * log P(t | t_{i-1})
+        where 'w' is 'transition_weight'. P(t | context) is interpolated
+        over all the orders of the context (see NgramTable.probabilities())
+        and unseen contexts back off to their longest seen ending. Characters
+        that were never seen take no tag at all, like the greedy decoder.
+        Transitions are smoothed by adding 'smoothing' to every count.
+        A model with no transition counts (trained before they were kept)
+        gives uniform transitions, so the decoders act like the greedy one.
+        All the log-probabilities are computed once (here) as dense arrays.
+        """
+        self.STATES = table.STATES
+        num_states = len(self.STATES)
+        #scores of a character that was never seen: only the null tag is possible
+        self.unseen_scores = np.full(num_states, -np.inf)
+        self.unseen_scores[table.state_index[table.NULL_TAG]] = 0.
+        #(contexts x states) log P(tag | context)
+        self.log_emission = np.log(np.maximum(table.probabilities(), MIN_PROBABILITY))
+        transitions = np.asarray(table.transitions, dtype=np.float64) + smoothing
+        log_transition = np.log(transitions / transitions.sum(axis=1, keepdims=True))
+        #(states x states) score of going from a tag (row) to another (column)
+        self.transition_scores = (transition_weight * log_transition[:num_states]).astype(np.float32)
+        #score of the first tag of a word
+        self.start_scores = (transition_weight * log_transition[num_states]).astype(np.float32)
+
+
+    def emissions(self, rows):
+        """
+        This method takes the row ids of the contexts of a word (-1 for
+        unseen contexts) and returns a (characters x states) score array
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        scores = self.log_emission[np.maximum(rows, 0)]
+        scores[rows < 0] = self.unseen_scores
+        return scores
+
+
+    def viterbi(self, rows):
+        """
+        This method returns the ids of the best sequence of tags for a
+        word given the row ids of its contexts. It keeps the best score of
+        every tag at every character, so it takes O(characters x states^2)
+        time and O(characters x states) memory.
+        """
+        if len(rows) == 0:
+            return []
+        emissions = self.emissions(rows)
+        backpointers = np.zeros((len(rows), len(self.STATES)), dtype=np.int8)
+        scores = self.start_scores + emissions[0]
+        for idx in range(1, len(rows)):
+            candidates = scores[:, None] + self.transition_scores #previous tag x tag
+            backpointers[idx] = candidates.argmax(axis=0)
+            scores = candidates.max(axis=0) + emissions[idx]
+        tag_id = int(scores.argmax())
+        tag_ids = [tag_id]
+        for idx in range(len(rows)-1, 0, -1):
+            tag_id = int(backpointers[idx, tag_id])
+            tag_ids.append(tag_id)
+        return tag_ids[::-1]
+
+
+    def beam_search(self, rows, beam_size=4):
+        """
+        This method approximates viterbi() by keeping only the best
+        'beam_size' tags at every character (the best sequence ending with
+        each of them), so a character costs O(beam_size x states) instead
+        of O(states^2). Sequences ending with the same tag are merged like
+        viterbi() does, so beam_size >= number of states gives the same
+        result as viterbi() (which is used then) and beam_size = 1 follows
+        the best tag at every character. With few states (16 tags) most of
+        the time goes to NumPy calls, so only beam_size = 1 is cheaper than
+        viterbi().
+        """
+        num_states = len(self.STATES)
+        if len(rows) == 0:
+            return []
+        if beam_size >= num_states:
+            return self.viterbi(rows)
+        emissions = self.emissions(rows)
+        scores = self.start_scores + emissions[0]
+        if beam_size == 1:
+            tag_id = int(scores.argmax())
+            tag_ids = [tag_id]
+            for idx in range(1, len(rows)):
+                tag_id = int((self.transition_scores[tag_id] + emissions[idx]).argmax())
+                tag_ids.append(tag_id)
+            return tag_ids
+        #the tag ids of the sequences in the beam, then the tag id before
+        #every tag (its best parent in the beam) at every character
+        kth = num_states - beam_size
+        beam = np.argpartition(scores, kth)[kth:]
+        scores = scores[beam]
+        parents = []
+        for idx in range(1, len(rows)):
+            candidates = scores[:, None] + self.transition_scores[beam] #sequence in the beam x tag
+            parents.append(beam[candidates.argmax(axis=0)])
+            tag_scores = candidates.max(axis=0) + emissions[idx]
+            beam = np.argpartition(tag_scores, kth)[kth:]
+            scores = tag_scores[beam]
+        #follow the best sequence back
+        tag_id = int(beam[scores.argmax()])
+        tag_ids = [tag_id]
+        for tag_parents in reversed(parents):
+            tag_id = int(tag_parents[tag_id])
+            tag_ids.append(tag_id)
+        return tag_ids[::-1]
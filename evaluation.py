@@ -0,0 +1,129 @@
+import multiprocessing
+from array import array
+import numpy as np
+
+from utils import *
+
+
+
+#the buckets of the word-accuracy histogram (the upper bounds of the first four)
+HISTOGRAM_LABELS = ['below 0.2', '0.2:0.4', '0.4:0.6', '0.6:0.8', 'above 0.8']
+HISTOGRAM_BOUNDS = [0.2, 0.4, 0.6, 0.8]
+
+
+
+def evaluate_file(job):
+    """
+    This function compares one gold file with its predicted file. It takes
+    a tuple of (gold_path, predicted_path, states) and returns a dictionary
+    of counts (see empty_counts()) that can be summed with other files'.
+    Every word is tokenized once into an array of tag ids (tags that are
+    not in 'states' get new ids after them), then all the words of the
+    file are compared at once using NumPy.
+    """
+    gold_path, predicted_path, states = job
+    tag_index = {tag: idx for idx, tag in enumerate(states)}
+    other_id = len(states)
+    counts = empty_counts(states)
+    gold_ids, predicted_ids = array('h'), array('h')
+    lengths = array('q') #number of tags of every word
+    with open_text(gold_path) as gold_fin, open_text(predicted_path) as predicted_fin:
+        for gold_word, predicted_word in zip(gold_fin, predicted_fin):
+            gold_word = gold_word.strip()
+            predicted_word = predicted_word.strip()
+            if len(gold_word) <2 or len(predicted_word) <2:  #empty line
+                continue
+            _, gold_tags = split_word(gold_word)
+            _, predicted_tags = split_word(predicted_word)
+            if len(gold_tags) != len(predicted_tags) or not gold_tags:
+                #the predicted word doesn't have the same characters
+                counts['misaligned_words'] += 1
+                continue
+            gold_ids.extend([tag_index.setdefault(tag, len(tag_index)) for tag in gold_tags])
+            predicted_ids.extend([tag_index.setdefault(tag, len(tag_index)) for tag in predicted_tags])
+            lengths.append(len(gold_tags))
+    if not lengths:
+        return counts
+
+    gold = np.frombuffer(gold_ids, dtype=np.int16).astype(np.intp)
+    predicted = np.frombuffer(predicted_ids, dtype=np.int16).astype(np.intp)
+    lengths = np.frombuffer(lengths, dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    correct = (gold == predicted)
+    #the last character of every word carries the case ending
+    last = np.zeros(len(gold), dtype=bool)
+    last[starts + lengths - 1] = True
+
+    correct_per_word = np.add.reduceat(correct.astype(np.int64), starts)
+    correct_last = correct[last]
+    counts['words'] = len(lengths)
+    counts['correct_words'] = int((correct_per_word == lengths).sum())
+    #a word is correct without its case ending if all the other characters are
+    counts['correct_words_no_case'] = int((correct_per_word - correct_last == lengths - 1).sum())
+    counts['chars'] = len(gold)
+    counts['correct_chars'] = int(correct.sum())
+    counts['chars_no_case'] = int(len(gold) - len(lengths))
+    counts['correct_chars_no_case'] = int(correct.sum() - correct_last.sum())
+    buckets = np.digitize(correct_per_word / lengths, HISTOGRAM_BOUNDS)
+    counts['histogram'] += np.bincount(buckets, minlength=len(HISTOGRAM_LABELS))
+    #all the tags that are not in 'states' share the last row/column
+    size = len(states) + 1
+    gold, predicted = np.minimum(gold, other_id), np.minimum(predicted, other_id)
+    counts['confusion'] += np.bincount(gold*size + predicted, minlength=size*size).reshape(size, size)
+    return counts
+
+
+def empty_counts(states):
+    """
+    This function returns the counts of an empty evaluation:
+    -> words, correct_words, correct_words_no_case: number of words, number
+       of words whose tags are all correct and the same ignoring the tag
+       of the last character (the case ending).
+    -> chars, correct_chars, chars_no_case, correct_chars_no_case: the same
+       for characters.
+    -> misaligned_words: words whose prediction doesn't have the same
+       characters as the gold word (they are not counted anywhere else).
+    -> histogram: number of words in each bucket of HISTOGRAM_LABELS.
+    -> confusion: confusion[gold tag id, predicted tag id], the last
+       row/column is for tags that are not in 'states'.
+    """
+    size = len(states) + 1
+    return {'words': 0, 'correct_words': 0, 'correct_words_no_case': 0,
+            'chars': 0, 'correct_chars': 0, 'chars_no_case': 0, 'correct_chars_no_case': 0,
+            'misaligned_words': 0,
+            'histogram': np.zeros(len(HISTOGRAM_LABELS), dtype=np.int64),
+            'confusion': np.zeros((size, size), dtype=np.int64)}
+
+
+def evaluate_files(pairs, states, workers=1):
+    """
+    This function evaluates many (gold_path, predicted_path) pairs, using
+    'workers' processes, and returns the summed counts (see empty_counts())
+    along with these metrics:
+    -> DER: diacritic error rate (wrong characters / characters).
+    -> WER: word error rate (words with any wrong character / words).
+    -> DER_no_case, WER_no_case: the same ignoring the case endings.
+    -> histogram_labels: the labels of the buckets of 'histogram'.
+    """
+    jobs = [(gold_path, predicted_path, tuple(states)) for gold_path, predicted_path in pairs]
+    total = empty_counts(states)
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        results = pool.imap(evaluate_file, jobs) if pool else map(evaluate_file, jobs)
+        for counts in results:
+            for key, value in counts.items():
+                total[key] = total[key] + value
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    total['DER'] = _rate(total['chars'] - total['correct_chars'], total['chars'])
+    total['WER'] = _rate(total['words'] - total['correct_words'], total['words'])
+    total['DER_no_case'] = _rate(total['chars_no_case'] - total['correct_chars_no_case'], total['chars_no_case'])
+    total['WER_no_case'] = _rate(total['words'] - total['correct_words_no_case'], total['words'])
+    total['histogram_labels'] = HISTOGRAM_LABELS
+    return total
+
+
+def _rate(count, total):
+    return count/total if total else 0.
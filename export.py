@@ -0,0 +1,216 @@
+import os
+import json
+import sqlite3
+import argparse
+import numpy as np
+
+from ngram_table import NgramTable, COUNT_DTYPE
+from utils import *
+
+
+
+#the first bytes of every SQLite database
+SQLITE_MAGIC = b'SQLite format 3\x00'
+#the extensions of the exported models (the binary columnar format is the
+#one of NgramTable.save_binary())
+TSV_EXTENSIONS = ('.tsv',)
+SQLITE_EXTENSIONS = ('.sqlite', '.sqlite3', '.db')
+#the name of the start of a word in the transitions
+START_TAG = 'START'
+#number of rows read or written at once
+CHUNK_SIZE = 1 << 16
+
+
+
+def export_tsv(table, path):
+    """
+    This function writes the counts of a frozen NgramTable as a sorted TSV
+    file (UTF-8, '\n' line endings) which works for any N:
+    -> metadata lines starting with '#': '#N', '#states' and '#null_tag'
+       followed by their values, '#source' (checksum, file name) and
+       '#transition' (previous tag or START, tag, count) lines.
+    -> a header line: context, tag, count.
+    -> one line for every seen (context, tag) pair, sorted by context then
+       by the order of the states. Contexts are N characters, the start
+       of a word is padded with '*'.
+    The table is written one chunk at a time, so a memory-mapped model
+    is never built in memory. Only the counts of the contexts of N
+    characters are written, the lower orders are computed out of them.
+    """
+    states = table.STATES
+    with open_text(path, 'w') as fout:
+        fout.write('#N\t%d\n' % table.N)
+        fout.write('#states\t%s\n' % '\t'.join(states))
+        fout.write('#null_tag\t%s\n' % table.NULL_TAG)
+        for checksum, filename in sorted(table.sources.items()):
+            fout.write('#source\t%s\t%s\n' % (checksum, filename))
+        previous_tags = list(states) + [START_TAG]
+        for prev_id, tag_id in zip(*np.nonzero(table.transitions)):
+            fout.write('#transition\t%s\t%s\t%d\n' % (previous_tags[prev_id], states[tag_id],
+                                                     table.transitions[prev_id, tag_id]))
+        fout.write('context\ttag\tcount\n')
+        for contexts, counts, _ in table.iter_rows(CHUNK_SIZE):
+            rows, cols = np.nonzero(counts)
+            fout.write(''.join(['%s\t%s\t%d\n' % (contexts[row_id], states[col_id], count)
+                                for row_id, col_id, count in zip(rows.tolist(), cols.tolist(),
+                                                                 counts[rows, cols].tolist())]))
+
+
+def import_tsv(path):
+    """
+    This function reads a TSV file written by export_tsv() and returns
+    it as an (unfrozen) NgramTable. The file is read line by line and the
+    counts are added in chunks.
+    """
+    metadata = {'sources': {}, 'transitions': []}
+    table = None
+    rows, cols, counts = [], [], []
+    with open_text(path) as fin:
+        for line in fin:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == '#N':
+                metadata['N'] = int(fields[1])
+            elif fields[0] == '#states':
+                metadata['states'] = fields[1:]
+            elif fields[0] == '#null_tag':
+                metadata['null_tag'] = fields[1]
+            elif fields[0] == '#source':
+                metadata['sources'][fields[1]] = fields[2]
+            elif fields[0] == '#transition':
+                metadata['transitions'].append(fields[1:])
+            elif table is None:
+                #the header line, the metadata is over
+                table = _new_table(metadata)
+            else:
+                context, tag, count = fields
+                rows.append(table.intern(context))
+                cols.append(table.state_index[tag])
+                counts.append(int(count))
+                if len(rows) >= CHUNK_SIZE:
+                    table.add(rows, cols, np.asarray(counts, dtype=COUNT_DTYPE))
+                    rows, cols, counts = [], [], []
+    assert table is not None, "Not an exported model: %s" % path
+    table.add(rows, cols, np.asarray(counts, dtype=COUNT_DTYPE))
+    return table
+
+
+def export_sqlite(table, path):
+    """
+    This function writes a frozen NgramTable into a (new) SQLite database
+    having these tables:
+    -> meta(key, value): N, states (a JSON list) and null_tag.
+    -> counts(context, tag, count): the counts of the contexts of N
+       characters, indexed on the context.
+    -> best_tags(context, tag): the best tag of the contexts of all orders
+       (see NgramTable.backoff_tag() for how to use them).
+    -> transitions(previous, tag, count) and sources(checksum, filename).
+    The rows are inserted one chunk at a time inside one transaction.
+    """
+    assert table.frozen, "Only frozen tables can be exported, call freeze() first."
+    if os.path.exists(path):
+        os.remove(path)
+    states = table.STATES
+    connection = sqlite3.connect(path)
+    try:
+        with connection:
+            connection.executescript("""
+                CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE counts (context TEXT NOT NULL, tag TEXT NOT NULL, count INTEGER NOT NULL);
+                CREATE TABLE best_tags (context TEXT PRIMARY KEY, tag TEXT NOT NULL) WITHOUT ROWID;
+                CREATE TABLE transitions (previous TEXT NOT NULL, tag TEXT NOT NULL, count INTEGER NOT NULL);
+                CREATE TABLE sources (checksum TEXT PRIMARY KEY, filename TEXT);
+            """)
+            connection.executemany("INSERT INTO meta VALUES (?, ?)",
+                                   [('N', str(table.N)), ('states', json.dumps(states)),
+                                    ('null_tag', table.NULL_TAG)])
+            connection.executemany("INSERT INTO sources VALUES (?, ?)", sorted(table.sources.items()))
+            previous_tags = list(states) + [START_TAG]
+            connection.executemany("INSERT INTO transitions VALUES (?, ?, ?)",
+                                   [(previous_tags[prev_id], states[tag_id], int(table.transitions[prev_id, tag_id]))
+                                    for prev_id, tag_id in zip(*np.nonzero(table.transitions))])
+            for contexts, counts, _ in table.iter_rows(CHUNK_SIZE):
+                rows, cols = np.nonzero(counts)
+                connection.executemany("INSERT INTO counts VALUES (?, ?, ?)",
+                                       [(contexts[row_id], states[col_id], count)
+                                        for row_id, col_id, count in zip(rows.tolist(), cols.tolist(),
+                                                                         counts[rows, cols].tolist())])
+            for contexts, _, best in table.iter_rows(CHUNK_SIZE, all_orders=True):
+                connection.executemany("INSERT INTO best_tags VALUES (?, ?)",
+                                       [(context, states[tag_id]) for context, tag_id in zip(contexts, best.tolist())
+                                        if tag_id >= 0])
+            #indexing once after inserting is faster than keeping it updated
+            connection.execute("CREATE INDEX counts_context ON counts (context)")
+    finally:
+        connection.close()
+
+
+def import_sqlite(path):
+    """
+    This function reads a database written by export_sqlite() and returns
+    it as an (unfrozen) NgramTable. The counts are read in chunks.
+    """
+    connection = sqlite3.connect(path)
+    try:
+        meta = dict(connection.execute("SELECT key, value FROM meta"))
+        table = _new_table({'N': int(meta['N']), 'states': json.loads(meta['states']),
+                            'null_tag': meta['null_tag'],
+                            'sources': dict(connection.execute("SELECT checksum, filename FROM sources")),
+                            'transitions': connection.execute("SELECT previous, tag, count FROM transitions").fetchall()})
+        cursor = connection.execute("SELECT context, tag, count FROM counts")
+        while True:
+            chunk = cursor.fetchmany(CHUNK_SIZE)
+            if not chunk:
+                break
+            table.add([table.intern(context) for context, _, _ in chunk],
+                      [table.state_index[tag] for _, tag, _ in chunk],
+                      np.asarray([count for _, _, count in chunk], dtype=COUNT_DTYPE))
+    finally:
+        connection.close()
+    return table
+
+
+def _new_table(metadata):
+    """an empty NgramTable with the given N, states, null tag, sources and transitions"""
+    table = NgramTable(metadata['N'], metadata['states'], metadata['null_tag'])
+    table.sources = dict(metadata['sources'])
+    previous_index = dict(table.state_index, **{START_TAG: len(table.STATES)})
+    for previous, tag, count in metadata['transitions']:
+        table.transitions[previous_index[previous], table.state_index[tag]] = int(count)
+    return table
+
+
+def is_exported(path):
+    """whether 'path' is a TSV file or a SQLite database (see load_exported())"""
+    if path.endswith(TSV_EXTENSIONS):
+        return True
+    with open(path, 'rb') as fin:
+        return fin.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+def load_exported(path):
+    """reads an exported model (TSV or SQLite) as an unfrozen NgramTable"""
+    if path.endswith(TSV_EXTENSIONS):
+        return import_tsv(path)
+    return import_sqlite(path)
+
+
+def save_exported(table, path):
+    """exports the given (frozen) table according to the extension of 'path'"""
+    if path.endswith(TSV_EXTENSIONS):
+        export_tsv(table, path)
+    elif path.endswith(SQLITE_EXTENSIONS):
+        export_sqlite(table, path)
+    else:
+        raise ValueError("Unknown export format: %s" % path)
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a model between its formats: pickle, binary (.bin), "
+                                     "TSV (.tsv) and SQLite (.sqlite, .sqlite3, .db).")
+    parser.add_argument('model', help="path of the trained model")
+    parser.add_argument('output', help="path of the converted model, its format is chosen by its extension")
+    args = parser.parse_args()
+    from hmm import convert_model
+    convert_model(args.model, args.output)
@@ -1,77 +1,240 @@
 import os
+import sys
+import argparse
+import multiprocessing
+import numpy as np
+from collections import Counter
 import _pickle as pickle
-from collections import defaultdict, deque
 
-from preprocess_data import Preprocessor
+from ngram_table import NgramTable, BINARY_MAGIC
+from export import is_exported, load_exported, save_exported, TSV_EXTENSIONS, SQLITE_EXTENSIONS
+from evaluation import evaluate_files
+from decoding import Decoder
+from metrics import Metrics, instrumented
 from utils import *
 
 
 
+DECODERS = ('greedy', 'viterbi', 'beam')
+
+
+
 class HMM(object):
-    def __init__(self, n=3):
-        """This method is used to initialize our Hidden Markov Model"""
+    def __init__(self, n=3, cache_size=10000, model_path=None, decoder='greedy', beam_size=4, metrics=None):
+        """
+        This method is used to initialize our Hidden Markov Model.
+        'cache_size' is the number of words whose diacritization is kept
+        in memory (0 disables caching).
+        'decoder' is how the tags of a word are chosen (see diacritized_word()):
+        'greedy', 'viterbi' or 'beam' (beam search keeping 'beam_size' sequences).
+        'metrics' is where the timers and counters of the model are kept
+        (see metrics.py and metrics_info()), a new Metrics() by default.
+        'model_path' is the path of the saved model, it's '<n>gram_CharModel.pickle'
+        in the current directory by default. When it's given, 'n' is read
+        from the saved model.
+        Nothing is written to the disk here, the data directories are
+        created only when they are needed (training, diacritizing data
+        or evaluating).
+        """
         assert n>=2, "Expecting n>=2."
+        assert decoder in DECODERS, "Expecting one of these decoders: %s" % ', '.join(DECODERS)
         #create member variables
         self.N = n
+        self.decoder = decoder
+        self.beam_size = beam_size
+        self._decoder_tables = None #built when first needed (see _get_decoder())
+        self.cache = LRUCache(cache_size) #(word, N, decoder, beam_size) -> diacritized word
+        self.metrics = metrics or Metrics()
         self.START = '*'
         self.NULL_TAG = 'O' #tag for characters that are NOT diacritizedd
-        self.STATES = {'ٌ', 'ً', 'ٍ', 'ُ', 'َ', 'ِ', 'ْ', 'ّ', 'ٌّ', 'ًّ', 'ٍّ', 'ُّ', 'َّ', 'ِّ', 'ّْ', 'O'}
+        self.STATES = ('ٌ', 'ً', 'ٍ', 'ُ', 'َ', 'ِ', 'ْ', 'ّ', 'ٌّ', 'ًّ', 'ٍّ', 'ُّ', 'َّ', 'ِّ', 'ّْ', 'O')
         #STATES are:
         #double damma, double fatha, double kasera, damma, fatha, kasera, sukoon, 
         #shadd+double damma, shadd+double fatha, shadd+double kasera
         #shadd+damma, shadd+fatha, shadd+kasera, shadd+skoon
+        #(the order matters, it's the column order of the count table)
+        #what's written after a character for every tag id (the last one is for -1, no tag)
+        self._tag_texts = [tag if tag != self.NULL_TAG else '' for tag in self.STATES] + ['']
 
         #load model if saved
+        self.model_path = model_path or str(self.N)+'gram_CharModel.pickle'
         try:
-            with open(str(self.N)+'gram_CharModel.pickle', 'rb') as fout:
-                self.character_ngram = pickle.load(fout)
-            print('Done Loading trained model!!')
+            self.character_ngram = self._load_model(self.model_path)
+            self.N = self.character_ngram.N
+            print('Done Loading trained model!!', file=sys.stderr)
         except FileNotFoundError:
+            if model_path:
+                raise
             #create member containers
-            self.character_ngram = defaultdict(int)
-        
-        #create files
-        self.data_dir = os.path.join(Preprocessor().out_dir)
+            self.character_ngram = NgramTable(self.N, self.STATES, self.NULL_TAG)
+        #the model is read-only unless it's being trained
+        self.character_ngram.freeze()
+
+        #data directories
+        self.data_dir = PREPROCESSED_DIR
         self.train_dir = os.path.join(self.data_dir, 'train') #contains files to train
-        create_dir(self.train_dir)
-        self.test_dir = os.path.join(self.data_dir, 'test') #contains files to test
-        create_dir(self.test_dir)
-        self.gold_dir = os.path.join(self.test_dir, 'gold') #contains files to evaluate
-        create_dir(self.gold_dir)
-        self.predicted_dir =  os.path.join(self.test_dir, 'predicted', str(self.N)+"gram") #contains model generated files
-        create_dir(os.path.join(self.test_dir, 'predicted'))
-        create_dir(self.predicted_dir)
-        self.test_dir = os.path.join(self.test_dir, 'test') #contains files to evaluate
-        create_dir(self.test_dir)
+        self.gold_dir = os.path.join(self.data_dir, 'test', 'gold') #contains files to evaluate
+        self.predicted_dir =  os.path.join(self.data_dir, 'test', 'predicted', str(self.N)+"gram") #contains model generated files
+        self.test_dir = os.path.join(self.data_dir, 'test', 'test') #contains files to evaluate
+
+
+    @classmethod
+    def load(cls, path, cache_size=10000, decoder='greedy', beam_size=4, metrics=None):
+        """
+        This method is the entry point for using a trained model for
+        inference only. It loads the model saved at 'path' and it
+        doesn't touch the disk other than reading this file.
+        >>> model = HMM.load('model_weights/2gram_CharModel.pickle')
+        """
+        return cls(cache_size=cache_size, model_path=path, decoder=decoder, beam_size=beam_size, metrics=metrics)
+
+
+    def _load_model(self, path):
+        """
+        This method reads a saved model (a pickle file, a binary model
+        file, see NgramTable.save_binary(), or an exported TSV or SQLite
+        model, see export.py) and returns it as an NgramTable
+        """
+        if is_exported(path):
+            return load_exported(path)
+        with open(path, 'rb') as fin:
+            if fin.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+                #binary models are memory-mapped
+                return NgramTable.load_binary(path)
+            fin.seek(0)
+            table = pickle.load(fin)
+        if not isinstance(table, NgramTable):
+            #model saved in the old format (a dictionary), n is the length of its contexts
+            n = len(next(iter(table))[0]) if table else self.N
+            table = NgramTable.from_dict(table, n, self.STATES, self.NULL_TAG)
+        return table
+
+
+    def merge(self, other):
+        """
+        This method adds the counts of another model (an HMM with the same
+        N or a path to a saved one) to this model. The two models must not
+        have counted the same files.
+        """
+        if not isinstance(other, HMM):
+            other = HMM.load(other, cache_size=0)
+        self.character_ngram.thaw()
+        try:
+            self.character_ngram.update(other.character_ngram)
+        finally:
+            self.character_ngram.freeze()
+        self._model_changed()
+
+
+    def save(self, path=None):
+        """
+        This method saves the model at 'path' (self.model_path by default).
+        If the path ends with '.bin', the model is saved in the binary format
+        which is memory-mapped when loaded. If it ends with '.tsv' or '.sqlite'
+        (or '.sqlite3', '.db'), it's exported (see export.py). Otherwise,
+        it's pickled.
+        """
+        path = path or self.model_path
+        if path.endswith('.bin'):
+            self.character_ngram.save_binary(path)
+        elif path.endswith(TSV_EXTENSIONS + SQLITE_EXTENSIONS):
+            save_exported(self.character_ngram, path)
+        else:
+            with open(path, 'wb') as fout:
+                pickle.dump(self.character_ngram, fout)
+
+
+    def _create_dirs(self):
+        """create the data directories if they don't already exist"""
+        for directory in [self.train_dir, self.gold_dir, self.predicted_dir, self.test_dir]:
+            create_dir(directory)
 
 
-    def train(self):
+    @instrumented('train')
+    def train(self, workers=1):
         """
         This method is used to train our Hidden Markov Model
         It reads the file in the 'train_dir' directory.
         Then, it trains a model and saves it.
+        The n-grams of every file are counted into a separate (small) table
+        then these tables are merged into the model in the same order as
+        the files, so 'workers' processes can count files in parallel and
+        the result is identical to training with one worker.
+        Training is incremental: the checksum of every counted file is kept
+        in the model, so files that were already counted are skipped and
+        only the counts of the new files are added.
+        The words that couldn't be counted are counted in self.metrics by
+        reason (see count_ngrams()).
         """
         print("----- Starting Training ------")
-        for filename in os.listdir(self.train_dir):
-            num_errors = 0
-            print("FILE:", filename)
-            with open(os.path.join(self.train_dir, filename), 'rb') as fin:
-                for word in fin.readlines():
-                    word = word.decode().strip()
-                    if word == '': #empty line
-                        continue
-                    try:
-                        charsonly, tagsonly = zip(*word_iterator(word))
-                        assert len(charsonly) == len(tagsonly)
-                        d = deque(self.START*(self.N-1), maxlen=self.N-1)
-                        for char, tag in zip(charsonly, tagsonly):
-                            self.character_ngram[(*d, char), tag] += 1.
-                            d.append(char)
-                    except:
-                        num_errors += 1
-            with open(str(self.N)+'gram_CharModel.pickle', 'wb') as fout:
-                pickle.dump(self.character_ngram, fout)
-            print("\tERROR:", num_errors)
+        self._create_dirs()
+        self.character_ngram.thaw()
+        filenames, checksums = [], []
+        for filename in sorted(os.listdir(self.train_dir)):
+            checksum = file_checksum(os.path.join(self.train_dir, filename))
+            if checksum in self.character_ngram.sources or checksum in checksums:
+                print("SKIPPING (already counted):", filename)
+                continue
+            filenames.append(filename)
+            checksums.append(checksum)
+        jobs = [(os.path.join(self.train_dir, filename), self.N, self.STATES, self.NULL_TAG, self.START)
+                for filename in filenames]
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+        try:
+            results = pool.imap(count_ngrams, jobs) if pool else map(count_ngrams, jobs)
+            for filename, checksum, (table, counts) in zip(filenames, checksums, results):
+                print("FILE:", filename)
+                table.sources[checksum] = filename
+                self.character_ngram.update(table)
+                self.metrics.update(counts)
+                #words that were skipped (see count_ngrams())
+                print("\tERROR:", counts['train.errors.invalid_utf8'] + counts['train.errors.single_character'])
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        self.character_ngram.freeze()
+        self.save()
+        self._model_changed()
+
+
+    def _model_changed(self):
+        """forget everything computed out of the old model"""
+        self.cache.clear()
+        self._decoder_tables = None
+
+
+    def _get_decoder(self):
+        """returns the Decoder (log-probability tables) of the current model"""
+        if self._decoder_tables is None:
+            self._decoder_tables = Decoder(self.character_ngram)
+        return self._decoder_tables
+
+
+    def cache_info(self):
+        """
+        This method returns the hits, misses and evictions of the word cache
+        used by diacritized_word() along with its current and maximum sizes.
+        """
+        return self.cache.info()
+
+
+    def metrics_info(self):
+        """
+        This method returns the timers and the counters of the model (see
+        Metrics.snapshot()) along with the counters of the cache:
+        -> timers: train, diacritized_data, evaluate and diacritize_batch.
+        -> train.*: words, characters and bytes counted and the words that
+           couldn't be counted by reason (train.errors.*).
+        -> diacritize.*: words, characters and bytes diacritized, the contexts
+           that were seen only at a lower order (backoff_contexts) and those
+           whose last character was never seen (unseen_contexts). The
+           words found in the cache aren't counted (see cache_info()).
+        -> evaluate.*: words, characters and bytes evaluated.
+        """
+        info = self.metrics.snapshot()
+        info['cache'] = self.cache_info()
+        return info
 
 
     def diacritized_word(self, word):
@@ -80,117 +243,383 @@ class HMM(object):
         the HMM model. 
         The input of this method is a clean word (with no discrentization)
         and this method returns a dicrentized word based on the trained model
+        How the tags are chosen depends on self.decoder:
+        -> 'greedy': every character takes the tag that was seen the most
+           after its context (the fastest).
+        -> 'viterbi': the best sequence of tags taking the transitions
+           between tags into account (see decoding.py).
+        -> 'beam': an approximation of 'viterbi' keeping only the best
+           'beam_size' tags at every character, it may miss the best sequence.
+        Since the same words appear over and over, the results are cached.
         """
+        cached = self.cache.get((word, self.N, self.decoder, self.beam_size))
+        if cached is not None:
+            #the hot path, it doesn't touch the metrics (see cache_info())
+            return cached
+        counts = Counter()
+        out_word = self._diacritized_word(word, counts)
+        self.metrics.update(counts)
+        return out_word
+
+
+    def _diacritized_word(self, word, counts):
+        """
+        diacritize a word that isn't in the cache and cache it, its metrics
+        are added to 'counts'
+        """
+        #empty words (like the blank lines between sentences) aren't words
+        counts['diacritize.words'] += 1 if word else 0
+        counts['diacritize.chars'] += len(word)
+        cache_key = (word, self.N, self.decoder, self.beam_size)
         #make sure that the word is with no discrentization
-        assert re.search(Preprocessor().VOWEL_REGEX, word) == None
-        dq = deque(self.START*(self.N-1), maxlen=self.N-1)
-        out_word = ''
-        for char in word:
-            winning_tag = self.NULL_TAG
-            top_count = 0
-            for tag in self.STATES:
-                if self.character_ngram[(*dq, char), tag] > top_count:
-                    winning_tag = tag
-                    top_count = self.character_ngram[(*dq, char), tag]
-            if winning_tag != self.NULL_TAG:
-                out_word += char+winning_tag
-            else:
-                out_word += char
-            dq.append(char)
-        return out_word 
-
-
-    def diacritized_data(self):
+        assert SHORT_VOWEL_REGEX.search(word) == None
+        if self.decoder != 'greedy':
+            out_word = self._decode_word(word, counts)
+            self.cache.put(cache_key, out_word)
+            return out_word
+        #best tag of every seen context, unseen ones back off to their
+        #longest seen ending
+        table = self.character_ngram
+        if table.keys is not None:
+            tag_ids, orders = table.word_best_tag_ids(word, self.START, with_orders=True)
+            for order in orders:
+                if order < self.N:
+                    counts['diacritize.backoff_contexts' if order else 'diacritize.unseen_contexts'] += 1
+        else:
+            #contexts couldn't be encoded as integers, use their strings
+            index = table.index
+            padded = self.START*(self.N-1) + word
+            tag_ids = []
+            for context in [padded[idx:idx+self.N] for idx in range(len(word))]:
+                row_id = index.get(context)
+                if row_id is None:
+                    #the context itself was just missed, so start from its ending
+                    row_id, order = table.backoff_id(context[1:], with_order=True)
+                    counts['diacritize.backoff_contexts' if order else 'diacritize.unseen_contexts'] += 1
+                tag_ids.append(int(table.best[row_id]) if row_id >= 0 else -1)
+        tag_texts = self._tag_texts
+        out_word = ''.join([char + tag_texts[tag_id] for char, tag_id in zip(word, tag_ids)])
+        self.cache.put(cache_key, out_word)
+        return out_word
+
+
+    def _decode_word(self, word, counts):
+        """diacritize a word using the Viterbi or the beam search decoder"""
+        table = self.character_ngram
+        if table.keys is not None:
+            rows, orders = table.word_backoff_ids(word, self.START)
+        else:
+            padded = self.START*(self.N-1) + word
+            found = [table.backoff_id(padded[idx:idx+self.N], with_order=True) for idx in range(len(word))]
+            rows, orders = [row_id for row_id, _ in found], [order for _, order in found]
+        self._count_contexts(counts, orders)
+        decoder = self._get_decoder()
+        if self.decoder == 'viterbi':
+            tag_ids = decoder.viterbi(rows)
+        else:
+            tag_ids = decoder.beam_search(rows, self.beam_size)
+        tags = [self.STATES[tag_id] for tag_id in tag_ids]
+        return ''.join([char + (tag if tag != self.NULL_TAG else '') for char, tag in zip(word, tags)])
+
+
+    def _count_contexts(self, counts, orders):
+        """
+        count the contexts that were seen only at a lower order and those
+        never seen given the order of the longest seen ending of every context
+        """
+        orders = np.asarray(orders)
+        counts['diacritize.backoff_contexts'] += int(np.count_nonzero((orders > 0) & (orders < self.N)))
+        counts['diacritize.unseen_contexts'] += int(np.count_nonzero(orders == 0))
+
+
+    def diacritize_batch(self, words):
+        """
+        This method is the batched version of diacritized_word(). It takes
+        a list of clean words (with no discrentization) and returns a list
+        of the dicrentized words in the same order.
+        Instead of handling one word at a time, all the characters of all
+        the words are encoded into one integer array. Then, the contexts
+        and their best tags are found using vectorized NumPy operations
+        and the output words are rebuilt in just one pass.
+        """
+        with self.metrics.timer('diacritize_batch'):
+            return self._diacritize_batch(list(words))
+
+
+    def _diacritize_batch(self, words):
+        """the body of diacritize_batch() (which times it)"""
+        counts = Counter()
+        if self.character_ngram.keys is None or self.decoder != 'greedy':
+            #contexts couldn't be encoded as integers or the tags of every
+            #word are decoded as a sequence, do it word by word
+            out_words = []
+            for word in words:
+                out_word = self.cache.get((word, self.N, self.decoder, self.beam_size))
+                if out_word is None:
+                    out_word = self._diacritized_word(word, counts)
+                out_words.append(out_word)
+        else:
+            out_words, orders = self._greedy_words(words)
+            counts.update({'diacritize.words': len(words) - words.count(''), 'diacritize.chars': len(orders)})
+            self._count_contexts(counts, orders)
+        self.metrics.update(counts)
+        return out_words
+
+
+    def _greedy_words(self, words):
+        """
+        This method diacritizes a list of words using the greedy decoder and
+        the integer keys of the contexts (table.keys mustn't be None). It
+        returns the diacritized words and the order of the longest seen
+        ending of every context (0 for unseen contexts).
+        """
+        table = self.character_ngram
+        lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+        text = ''.join(words)
+        if text == '':
+            return ['']*len(words), np.zeros(0, dtype=np.int64)
+        #make sure that the words are with no discrentization
+        assert SHORT_VOWEL_REGEX.search(text) == None
+        points = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        #position of every character inside its word
+        ends = np.cumsum(lengths)
+        positions = np.arange(len(points)) - np.repeat(ends-lengths, lengths)
+        start_code = table.encode(np.array([ord(self.START)], dtype=np.uint32))[0]
+        keys = table.context_keys(table.encode(points), positions, start_code)
+        tag_ids, orders = table.best_tag_ids(keys, with_orders=True)
+        #rebuild the words: every character is followed by its tag, then
+        #the output is sliced by the lengths of the output words (words may
+        #contain any character, so no separator is safe)
+        tags = np.array(self._tag_texts, dtype=object)
+        tag_lengths = np.array([len(tag) for tag in tags], dtype=np.int64)
+        pieces = np.empty(2*len(points), dtype=object)
+        pieces[0::2] = list(text)
+        pieces[1::2] = tags[tag_ids]
+        out_text = ''.join(pieces)
+        out_ends = np.concatenate([[0], np.cumsum(1 + tag_lengths[tag_ids])])
+        out_words = [out_text[start:end] for start, end in zip(out_ends[ends-lengths].tolist(), out_ends[ends].tolist())]
+        return out_words, orders
+
+
+    def diacritize_text(self, text):
+        """
+        This method takes a sentence (or a whole document) of clean words
+        and returns it diacritized. The whitespaces between the words are
+        kept as they are.
+        """
+        return self.diacritize_texts([text])[0]
+
+
+    def diacritize_texts(self, texts):
+        """
+        This method is the batched version of diacritize_text(), the words
+        of all the texts are diacritized at once using diacritize_batch().
+        """
+        tokens = [re.split(r'(\s+)', text) for text in texts]
+        out_words = iter(self.diacritize_batch([word for text_tokens in tokens for word in text_tokens[0::2]]))
+        for text_tokens in tokens:
+            num_words = (len(text_tokens)+1) // 2 #words are at the even positions
+            text_tokens[0::2] = [next(out_words) for _ in range(num_words)]
+        return [''.join(text_tokens) for text_tokens in tokens]
+
+
+    @instrumented('diacritized_data')
+    def diacritized_data(self, in_path=None, out_path=None, batch_size=10000):
         """
         This method is used to diacritized the undiacritizedd words
         in the test set.
+        If 'in_path' and 'out_path' are given, it diacritizes the file
+        'in_path' and writes the result into 'out_path' instead ('-'
+        stands for stdin/stdout). See diacritize_stream().
         """
+        if in_path is not None or out_path is not None:
+            with open_text(in_path or '-') as fin, open_text(out_path or '-', 'w') as fout:
+                self.diacritize_stream(fin, fout, batch_size)
+            self._count_bytes(in_path, out_path)
+            return
         print("----- Starting discrentization ------")
+        self._create_dirs()
         for filename in os.listdir(self.test_dir):
             print("FILE:", filename)
-            with open(os.path.join(self.test_dir, filename), 'rb') as fin, \
-              open(os.path.join(self.predicted_dir, filename), 'wb') as fout:
-                for word in fin.readlines():
-                    word = word.decode().strip()
-                    if word == '': #empty line
-                        fout.write('\n'.encode())
-                    else:
-                        fout.write(self.diacritized_word(word).encode())
-                        fout.write('\n'.encode())
+            in_path = os.path.join(self.test_dir, filename)
+            out_path = os.path.join(self.predicted_dir, filename)
+            with open_text(in_path) as fin, open_text(out_path, 'w') as fout:
+                self.diacritize_stream(fin, fout, batch_size)
+            self._count_bytes(in_path, out_path)
         print("Done discrentizing data!!")
 
 
-    def evaluate(self, analysis=False):
+    def _count_bytes(self, in_path, out_path):
+        """count the sizes of the diacritized files (stdin/stdout aren't counted)"""
+        if isinstance(in_path, str) and in_path != '-':
+            self.metrics.count('diacritize.bytes_read', os.path.getsize(in_path))
+        if isinstance(out_path, str) and out_path != '-':
+            self.metrics.count('diacritize.bytes_written', os.path.getsize(out_path))
+
+
+    def diacritize_stream(self, fin, fout, batch_size=10000):
+        """
+        This method diacritizes the words read from 'fin' (one word per
+        line, sentences are separated by an empty line) and writes them
+        into 'fout' in the same format. It works as a pipeline:
+        -> sentences are read one at a time from the (buffered) file.
+        -> they are grouped into batches of around 'batch_size' words
+           which are diacritized using diacritize_batch(). Sentences longer
+           than 'batch_size' words are split between batches.
+        -> each batch is written at once to the (buffered) output.
+        So, the memory used doesn't depend on the size of the file.
+        """
+        batch = []
+        for sentence in iter_sentences(fin, batch_size):
+            batch.extend(sentence)
+            if len(batch) >= batch_size:
+                fout.write('\n'.join(self.diacritize_batch(batch)) + '\n')
+                batch = []
+        if batch:
+            fout.write('\n'.join(self.diacritize_batch(batch)) + '\n')
+
+
+    @instrumented('evaluate')
+    def evaluate(self, analysis=False, workers=1):
         """
         This method is used to evaluate the performance of our Hidden Markov Model.
         It uses the dicrentized files that have been created by our model which
         are created in 'predicted_dir' directory and the original (true) files
-        located at 'test_dir' directory.
-        This function returns just the accuracy of the model
+        located at 'gold_dir' directory. The files are evaluated using 'workers'
+        processes (see evaluation.py).
+        This function returns a dictionary of the results which contains:
         -> (number of correct words, number of total words)
         -> (number of correct characters, number of total characters)
-        -> dictionary of error scores whose keys are are seperated by 0.2
-           so we have a total of five keys
+        -> the same ignoring case endings (the tag of the last character)
+        -> DER & WER (diacritic & word error rates) with and without case endings
+        -> histogram of words' accuracy in five buckets seperated by 0.2
+        -> confusion matrix of the tags
         """
         print("----- Starting Evaluation ------")
-        num_correct_words, total_num_words = (0., 0.)
-        num_correct_chars, total_num_chars = (0., 0.)
-        histogram = defaultdict(int)
-        for filename in os.listdir(self.predicted_dir):
+        self._create_dirs()
+        filenames = sorted(os.listdir(self.predicted_dir))
+        for filename in filenames:
             print("FILE:", filename)
-            with open(os.path.join(self.gold_dir, filename), 'rb') as gold_fin, \
-              open(os.path.join(self.predicted_dir, filename), 'rb') as predicted_fin:
-                for gold_word, predicted_word in zip(gold_fin.readlines(), predicted_fin.readlines()):
-                    gold_word = gold_word.decode().strip()
-                    predicted_word = predicted_word.decode().strip()
-                    if len(gold_word) <2 or len(predicted_word) <2:  #empty line
-                        continue
-                    total_num_words += 1.
-                    correct_chars, word_chars = evaluate_word(gold_word, predicted_word, analysis=True)
-                    if correct_chars == word_chars:
-                        num_correct_words += 1.
-                    num_correct_chars += correct_chars
-                    total_num_chars += word_chars
-                    #----- Handle the histogram -----
-                    acc = correct_chars/word_chars
-                    if acc < 0.2:
-                        histogram['below 0.2'] += 1
-                    elif acc < 0.4:
-                        histogram['0.2:0.4'] += 1
-                    elif acc<0.6:
-                        histogram['0.4:0.6'] += 1
-                    elif acc<0.6:
-                        histogram['0.6:0.8'] += 1
-                    else:
-                        histogram['above 0.8'] += 1
-            # break
-            print('This model has got:')
-            if analysis:
-                print('\tCorrect words: %d out of %d' %(num_correct_words, num_correct_chars))
-                print('\tCorrect characters: %d out of %d' %(num_correct_chars, total_num_chars))
-                draw_histogram(histogram, filename=str(self.N)+"gram_histogram.jpg")
-            print('\tAn accuracy (character-wise): %f' %(num_correct_chars/total_num_chars))
-            print('\tAn accuracy (word-wise):  %f ' %(num_correct_words/total_num_words))
+        pairs = [(os.path.join(self.gold_dir, filename), os.path.join(self.predicted_dir, filename))
+                 for filename in filenames]
+        results = evaluate_files(pairs, self.STATES, workers)
+        self.metrics.update({'evaluate.words': results['words'], 'evaluate.chars': results['chars'],
+                             'evaluate.misaligned_words': results['misaligned_words'],
+                             'evaluate.bytes_read': sum(os.path.getsize(path) for pair in pairs for path in pair)})
+        print('This model has got:')
+        if analysis:
+            print('\tCorrect words: %d out of %d' %(results['correct_words'], results['words']))
+            print('\tCorrect characters: %d out of %d' %(results['correct_chars'], results['chars']))
+            print('\tMisaligned words (not evaluated): %d' %results['misaligned_words'])
+            print('\tDER: %f (%f without case endings)' %(results['DER'], results['DER_no_case']))
+            print('\tWER: %f (%f without case endings)' %(results['WER'], results['WER_no_case']))
+            labels = list(self.STATES) + ['?']
+            confusion = results['confusion'].copy()
+            np.fill_diagonal(confusion, 0)
+            print('\tMost common mistakes (gold -> predicted):')
+            for flat_idx in confusion.argsort(axis=None)[::-1][:10]:
+                gold_id, predicted_id = np.unravel_index(flat_idx, confusion.shape)
+                if confusion[gold_id, predicted_id] == 0:
+                    break
+                print('\t\t%s -> %s: %d' %(labels[gold_id], labels[predicted_id], confusion[gold_id, predicted_id]))
+            histogram = dict(zip(results['histogram_labels'], results['histogram'].tolist()))
+            draw_histogram(histogram, filename=str(self.N)+"gram_histogram.jpg")
+        if results['chars']:
+            print('\tAn accuracy (character-wise): %f' %(results['correct_chars']/results['chars']))
+            print('\tAn accuracy (word-wise):  %f ' %(results['correct_words']/results['words']))
+        return results
 
 
 
 
 
-if __name__ == "__main__":
-    hmm = HMM()
-    word = 'مقدمة'
-    predicted = hmm.diacritized_word(word)
-    gold_word = 'مُقَدِّمَةُ'
-    print(evaluate_word(gold_word, predicted))
-    # hmm.train()
-    # hmm.diacritized_data()
-    # hmm.evaluate(analysis=True)
-    # words = ['مُقَدِّمَةُ', 'الطَّبَرِيِّ', 'شَيْخِ', 'الدِّينِ', 'فَجَاءَ', 'فِيهِ', 'بِالْعَجَبِ', 'الْعُجَابِ', 'وَنَثَرَ', 'فِيهِ', 'أَلْبَابَ', 'الْأَلْبَاب']
-    # for word in words:
-    #     tmp = hmm.diacritized_word(clean_word(word))
-    #     print(tmp)
-    #     print(evaluate_word(word, tmp))
-    print("done!!")
+def count_ngrams(job):
+    """
+    This function counts the character n-grams of one training file.
+    It takes a tuple of (path, n, states, null_tag, start) and returns
+    an NgramTable with the counts of this file along with a Counter of:
+    -> train.words, train.chars, train.bytes_read: what was counted.
+    -> train.errors.<reason>: the words that couldn't be counted, the
+       reasons are: invalid_utf8, single_character (a word of one
+       character has no tag) and unknown_tag (words having tags that
+       aren't in 'states', their other characters are still counted).
+    It's used by HMM.train() and it's defined here (not as a method) so
+    it can be sent to other processes.
+    """
+    path, n, states, null_tag, start = job
+    table = NgramTable(n, states, null_tag)
+    counts = Counter({'train.bytes_read': os.path.getsize(path)})
+    rows, cols = [], [] #(context id, tag id) of every character in the file
+    prev_ids, next_ids = [], [] #(previous tag id, tag id) of every transition
+    with open(path, 'rb') as fin:
+        for word in fin:
+            try:
+                word = word.decode().strip()
+            except UnicodeDecodeError:
+                counts['train.errors.invalid_utf8'] += 1
+                continue
+            if word == '': #empty line
+                continue
+            charsonly, tag_ids = split_word(word, table.state_index)
+            if not charsonly: #a single character with no tag
+                counts['train.errors.single_character'] += 1
+                continue
+            counts['train.words'] += 1
+            counts['train.chars'] += len(charsonly)
+            padded = start*(n-1) + charsonly
+            prev_id = len(states) #start of the word
+            if -1 in tag_ids:
+                counts['train.errors.unknown_tag'] += 1
+            for idx, col_id in enumerate(tag_ids):
+                if col_id < 0: #tag that can never be predicted
+                    prev_id = -1
+                    continue
+                rows.append(table.intern(padded[idx:idx+n]))
+                cols.append(col_id)
+                if prev_id >= 0:
+                    prev_ids.append(prev_id)
+                    next_ids.append(col_id)
+                prev_id = col_id
+    table.add(rows, cols)
+    table.add_transitions(prev_ids, next_ids)
+    return table, counts
+
+
+def merge_models(paths, out_path):
+    """
+    This function merges many saved models (with the same N) into one
+    model and saves it at 'out_path'.
+    >>> merge_models(['3gram_old.bin', '3gram_nightly.bin'], '3gram_CharModel.bin')
     """
+    model = HMM.load(paths[0], cache_size=0)
+    for path in paths[1:]:
+        model.merge(path)
+    model.save(out_path)
 
-    """
\ No newline at end of file
+
+def convert_model(in_path, out_path):
+    """
+    This function converts a saved model from a format to another, the
+    formats are chosen by the extensions (see HMM.save()). For example,
+    a model saved as a pickle file (in the old dictionary format or as an
+    NgramTable) can be converted into the binary format or exported:
+    >>> convert_model('model_weights/2gram_CharModel.pickle', '2gram_CharModel.bin')
+    >>> convert_model('2gram_CharModel.bin', '2gram_CharModel.tsv')
+    """
+    HMM.load(in_path, cache_size=0).save(out_path)
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Diacritize a file (one word per line, "
+                                     "sentences are separated by an empty line) using a trained model.")
+    parser.add_argument('model', help="path of the trained model (pickle or binary)")
+    parser.add_argument('input', nargs='?', default='-', help="file to diacritize (stdin by default)")
+    parser.add_argument('output', nargs='?', default='-', help="where to write the result (stdout by default)")
+    parser.add_argument('--batch-size', type=int, default=10000, help="number of words diacritized at once")
+    parser.add_argument('--decoder', choices=DECODERS, default='greedy', help="how the tags of a word are chosen")
+    parser.add_argument('--beam-size', type=int, default=4, help="number of sequences kept by the beam decoder")
+    args = parser.parse_args()
+    model = HMM.load(args.model, cache_size=10000, decoder=args.decoder, beam_size=args.beam_size)
+    model.diacritized_data(args.input, args.output, args.batch_size)
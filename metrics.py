@@ -0,0 +1,138 @@
+import os
+import time
+import logging
+import cProfile
+import functools
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+
+
+#used when logging is enabled (see Metrics), configure it like any other logger
+logger = logging.getLogger('tashkeela')
+
+
+
+class Metrics(object):
+    def __init__(self, log=False, profile_dir=None):
+        """
+        This class collects what happens inside a model:
+        -> counters: named counts (words, characters, unseen contexts,
+           tokenization errors by reason, bytes read & written, ...).
+        -> timers: the total time spent in every stage (train, evaluate,
+           diacritize_batch, ...) and how many times it was run.
+        If 'log' is True, the time and the counters of every finished
+        stage are logged (as INFO) using the 'tashkeela' logger.
+        If 'profile_dir' is given, the main stages (see stage()) are run
+        under cProfile and their stats are saved in this directory as
+        '<stage>.prof' (open them using pstats or snakeviz).
+        It can be used safely from many threads.
+        """
+        self.log = log
+        self.profile_dir = profile_dir
+        self.counters = Counter()
+        self.timers = {} #stage -> [seconds, calls]
+        self._lock = threading.Lock()
+        self._profiling = False
+
+
+    def count(self, name, value=1):
+        """adds 'value' to the counter 'name'"""
+        with self._lock:
+            self.counters[name] += value
+
+
+    def update(self, counters):
+        """adds many counters at once (a dictionary: name -> value)"""
+        with self._lock:
+            self.counters.update(counters)
+
+
+    @contextmanager
+    def timer(self, name):
+        """
+        This method is a context manager that adds the time spent inside
+        it to the timer 'name':
+        >>> with metrics.timer('diacritize_batch'):
+                ...
+        """
+        if self.log:
+            before = Counter(self.counters)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                timer = self.timers.setdefault(name, [0., 0])
+                timer[0] += seconds
+                timer[1] += 1
+            if self.log:
+                changes = Counter(self.counters)
+                changes.subtract(before)
+                logger.info('%s took %.3f seconds %s', name, seconds,
+                            dict((key, value) for key, value in changes.items() if value))
+
+
+    @contextmanager
+    def stage(self, name):
+        """
+        This method does the same as timer() and it also profiles what's
+        run inside it if 'profile_dir' was given. Stages inside a profiled
+        stage aren't profiled separately (they are already in its stats).
+        """
+        if not self.profile_dir or self._profiling:
+            with self.timer(name):
+                yield
+            return
+        profiler = cProfile.Profile()
+        self._profiling = True
+        try:
+            with self.timer(name):
+                profiler.enable()
+                try:
+                    yield
+                finally:
+                    profiler.disable()
+        finally:
+            self._profiling = False
+            if not os.path.isdir(self.profile_dir):
+                os.makedirs(self.profile_dir)
+            profiler.dump_stats(os.path.join(self.profile_dir, name + '.prof'))
+
+
+    def snapshot(self):
+        """
+        This method returns all the metrics as a (JSON-ready) dictionary:
+        {'counters': {name: value}, 'timers': {stage: {'seconds': .., 'calls': ..}}}
+        """
+        with self._lock:
+            return {'counters': dict(self.counters),
+                    'timers': {name: {'seconds': seconds, 'calls': calls}
+                               for name, (seconds, calls) in self.timers.items()}}
+
+
+    def reset(self):
+        """sets all the counters and timers back to zero"""
+        with self._lock:
+            self.counters.clear()
+            self.timers.clear()
+
+
+
+def instrumented(name):
+    """
+    This function is a decorator of HMM methods, it runs the whole method
+    as a stage of the model's metrics (see Metrics.stage()):
+    >>> @instrumented('train')
+        def train(self, workers=1):
+            ...
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.stage(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,956 @@
+import os
+import json
+import threading
+import numpy as np
+
+
+
+#counts are whole numbers, so 32-bit unsigned integers are more than enough
+#for the whole Tashkeela corpus (~75M words) and take half the space of floats
+COUNT_DTYPE = np.uint32
+
+#codes of characters when contexts are encoded as integers (see encode()),
+#the characters of the vocabulary start from FIRST_CODE
+UNKNOWN_CODE = 1
+FIRST_CODE = 2
+
+#the binary model format (see save_binary()), the file starts with the magic
+#bytes then the version and the length of a JSON header (both uint32)
+BINARY_MAGIC = b'TASHKEEL'
+BINARY_VERSION = 2
+BINARY_ALIGNMENT = 64
+
+
+
+class NgramTable(object):
+    def __init__(self, n, states, null_tag='O'):
+        """
+        This class is a compact replacement of the old dictionary whose keys
+        were ((*context, char), tag) tuples. It stores:
+        -> contexts: every context (n consecutive characters) is stored once
+           as a string and interned into an integer id (row number).
+        -> counts: a dense (contexts x states) array where each column
+           stands for a tag in 'states' (in the same order).
+        So, the count of the key (('*', 'م', 'ق'), 'َ') is found at
+        counts[index['*مق'], states.index('َ')]
+        Once frozen, it also stores:
+        -> the lower orders: the contexts of 1..n-1 characters (the ends of
+           the counted contexts) with their counts, they are summed out of
+           the counts of the n-character contexts (see freeze()). So, all
+           the orders share the same contexts list and count array.
+        -> best: the id of the best tag of every context using Witten-Bell
+           interpolation of all its orders (see probabilities()). Unseen
+           contexts back off to their longest seen ending (see backoff_tag()).
+        -> vocab, keys, key_backoff: every context is encoded as one integer
+           (its characters' codes in base len(vocab)+FIRST_CODE, the last
+           character is the most significant) and these integers are sorted,
+           so a whole batch of contexts can be looked up at once using NumPy
+           and the longest seen ending of any context is one of its two
+           neighbours (see encode() and best_tag_ids()).
+        Then, the rows are sorted by their keys and the table keeps no
+        strings at all: contexts are found using the keys, the counts are
+        kept as sparse rows (only the non-zero counts, see _compact()) and
+        the contexts are decoded out of the keys only when they are listed.
+        This takes a few bytes per context instead of hundreds. Contexts
+        that don't fit into 64-bit keys (a huge N) keep the strings.
+        -> transitions: a (states+1 x states) array of how many times a tag
+           was followed by another tag inside a word. The last row is for
+           the first character of a word (the start of the word).
+        -> sources: the checksums of the files that were counted into the
+           table (checksum -> file name), so the same file is never
+           counted twice.
+        A frozen table can be saved in a binary format (see save_binary())
+        which is loaded using memory-mapping. Its rows are sorted by their
+        keys too, so it's used the same way (without the keys, the contexts
+        and the index are built when they are first used).
+        """
+        self.N = n
+        self.STATES = tuple(states)
+        self.state_index = {tag: idx for idx, tag in enumerate(self.STATES)}
+        self.NULL_TAG = null_tag
+        self._contexts = [] #row id -> context
+        self._index = {}    #context -> row id
+        self._points = None #(contexts x N) code points, used instead of the contexts when memory-mapped
+        self._lock = threading.Lock() #guards building the contexts of a memory-mapped table
+        self._counts = np.zeros((0, len(self.STATES)), dtype=COUNT_DTYPE)
+        self._sparse = None #(row starts, tag ids, counts) used instead of the counts when compact
+        self.transitions = np.zeros((len(self.STATES)+1, len(self.STATES)), dtype=COUNT_DTYPE)
+        self.sources = {}   #checksum -> file name
+        self.frozen = False
+        self.best = None   #row id -> id of the best tag (-1 when all counts are zeros)
+        self.vocab = None  #sorted code points of all characters in the contexts
+        self.radix = None
+        self._char_codes = None #character -> its code (see encode())
+        self._weights = None #radix ** column, the last column first
+        self.keys = None   #sorted integer encoding of the contexts
+        self.key_backoff = None #(keys x N) best tag id of every ending of every key
+
+
+    def __len__(self):
+        if self._contexts is not None:
+            return len(self._contexts)
+        if self._points is not None:
+            return len(self._points)
+        return len(self.keys)
+
+
+    @property
+    def contexts(self):
+        """
+        The list of contexts (row id -> context). Tables found by their keys
+        don't keep it, it's decoded again on every call (keep the result).
+        """
+        if self._contexts is None:
+            if self.keys is not None:
+                return self._point_contexts(self._padded_points())
+            self._materialize()
+        return self._contexts
+
+
+    @property
+    def index(self):
+        """
+        The dictionary of contexts (context -> row id). Like the contexts,
+        it's built again on every call for tables found by their keys.
+        """
+        if self._index is None:
+            if self.keys is not None:
+                return {context: idx for idx, context in enumerate(self.contexts)}
+            self._materialize()
+        return self._index
+
+
+    @property
+    def _keyed(self):
+        """whether the rows are found using the keys (the rows are sorted by their keys)"""
+        return self._contexts is None and self.keys is not None
+
+
+    def _materialize(self):
+        """
+        build the contexts and the index of a memory-mapped table that has
+        no keys (only once, even if many threads ask for them at once)
+        """
+        with self._lock:
+            if self._points is None:
+                #built by another thread
+                return
+            contexts = self._point_contexts(self._points)
+            #the index first, the contexts are what's checked
+            self._index = {context: idx for idx, context in enumerate(contexts)}
+            self._contexts = contexts
+            self._points = None
+
+
+    def _point_contexts(self, points):
+        """the contexts (strings) of the given (contexts x N) code points"""
+        text = np.ascontiguousarray(points).tobytes().decode('utf-32-le')
+        #shorter contexts are padded with zeros at the beginning
+        return [text[idx:idx+self.N].lstrip('\0') for idx in range(0, len(text), self.N)]
+
+
+    @property
+    def counts(self):
+        """
+        The (contexts x states) count array (without the spare capacity),
+        a new read-only array when the counts are kept as sparse rows
+        """
+        if self._sparse is not None:
+            return self._count_rows(np.arange(len(self)))
+        return self._counts[:len(self)]
+
+
+    def _count_rows(self, rows):
+        """the (rows x states) counts of the given row ids"""
+        rows = np.asarray(rows, dtype=np.intp)
+        if self._sparse is None:
+            return np.asarray(self._counts[rows])
+        starts, tag_ids, values = self._sparse
+        begins = starts[rows]
+        lengths = starts[rows+1] - begins
+        #the positions of the non-zero counts of all the rows, one row after the other
+        positions = np.arange(lengths.sum()) + np.repeat(begins - (np.cumsum(lengths) - lengths), lengths)
+        counts = np.zeros((len(rows), len(self.STATES)), dtype=COUNT_DTYPE)
+        counts[np.repeat(np.arange(len(rows)), lengths), tag_ids[positions]] = values[positions]
+        counts.flags.writeable = False
+        return counts
+
+
+    def _find_row(self, context):
+        """the row id of the given context (-1 if it was never seen)"""
+        if not self._keyed:
+            return self.index.get(context, -1)
+        key = self._context_key(context)
+        if key is None:
+            return -1
+        row_id = int(self.keys.searchsorted(key))
+        return row_id if row_id < len(self.keys) and self.keys[row_id] == key else -1
+
+
+    def _context_key(self, context):
+        """the integer key of a context (None if it can't be a seen context)"""
+        if len(context) > self.N:
+            return None
+        key = 0
+        for char in context: #padded with zeros at the beginning
+            code = self._char_codes.get(char)
+            if code is None:
+                return None
+            key = key // self.radix + code * self.radix ** (self.N-1)
+        return key if context else None
+
+
+    def context_id(self, context):
+        """
+        This method returns the row id of the given context (a string of
+        N characters or less) or -1 if this context was never seen.
+        """
+        return self._find_row(context)
+
+
+    def backoff_id(self, context, with_order=False):
+        """
+        This method returns the row id of the longest seen ending of the
+        given context (the context itself if it was seen) or -1 if even
+        its last character was never seen. If 'with_order' is True, the
+        length of this ending (0 if it wasn't seen) is returned too.
+        """
+        for start in range(len(context)):
+            row_id = self._find_row(context[start:])
+            if row_id >= 0:
+                return (row_id, len(context)-start) if with_order else row_id
+        return (-1, 0) if with_order else -1
+
+
+    def backoff_tag(self, context):
+        """
+        This method returns the best tag of the longest seen ending of the
+        given context (see backoff_id()) or NULL_TAG if even its last
+        character was never seen. A seen context costs one lookup and every
+        missing order costs one more.
+        """
+        row_id = self.backoff_id(context)
+        if row_id < 0 or self.best[row_id] < 0:
+            return self.NULL_TAG
+        return self.STATES[self.best[row_id]]
+
+
+    def intern(self, context):
+        """
+        This method returns the row id of the given context, it creates
+        a new (empty) row for it if the context was never seen before.
+        """
+        row_id = self.index.get(context)
+        if row_id is None:
+            assert not self.frozen, "Can't add contexts to a frozen table, call thaw() first."
+            row_id = len(self.contexts)
+            self.index[context] = row_id
+            self.contexts.append(context)
+        return row_id
+
+
+    def add(self, rows, cols, counts=1):
+        """
+        This method takes two sequences of the same length: row ids
+        (returned by intern()) and column ids (tag indices) and it
+        increments the count of each (row, col) pair by 'counts'.
+        Duplicated pairs are accumulated correctly.
+        """
+        assert not self.frozen, "Can't update a frozen table, call thaw() first."
+        self._reserve(len(self))
+        np.add.at(self._counts, (np.asarray(rows, dtype=np.intp),
+                                 np.asarray(cols, dtype=np.intp)), counts)
+
+
+    def add_transitions(self, prev_ids, tag_ids):
+        """
+        This method takes two sequences of the same length: the ids of the
+        previous tags (len(self.STATES) for the start of a word) and the
+        ids of the tags that followed them, and it counts these transitions.
+        """
+        assert not self.frozen, "Can't update a frozen table, call thaw() first."
+        np.add.at(self.transitions, (np.asarray(prev_ids, dtype=np.intp),
+                                     np.asarray(tag_ids, dtype=np.intp)), 1)
+
+
+    def update(self, other):
+        """
+        This method adds the counts of another table (with the same N
+        and states) to this one. Adding tables is associative, so tables
+        counted separately (in different processes for example) can be
+        merged in any grouping and give the same counts.
+        Tables that have counted the same file can't be merged.
+        """
+        assert (other.N, other.STATES) == (self.N, self.STATES), "Can't merge different models."
+        common = set(self.sources) & set(other.sources)
+        assert not common, "Both models have counted: %s" % ', '.join(sorted(other.sources[c] for c in common))
+        self.sources.update(other.sources)
+        #the lower orders of a frozen table are left out, they are rebuilt by freeze()
+        top = other._top_rows()
+        contexts = other.contexts
+        rows = [self.intern(contexts[row_id]) for row_id in top.tolist()]
+        self._reserve(len(self))
+        #rows are unique, so there's no need for np.add.at()
+        self._counts[rows] += other._count_rows(top)
+        self.transitions += other.transitions
+
+
+    def row(self, context):
+        """
+        This method returns the counts of all the tags of the given
+        context in one call (as an array ordered like self.STATES),
+        or None if the context was never seen.
+        """
+        row_id = self._find_row(context)
+        if row_id < 0:
+            return None
+        return self._count_rows([row_id])[0]
+
+
+    def best_tag_id(self, context):
+        """
+        This method returns the id of the tag with the highest count
+        for the given context or -1 if this context was never seen.
+        It works only on frozen tables where these ids are precomputed.
+        """
+        row_id = self._find_row(context)
+        if row_id < 0:
+            return -1
+        return self.best[row_id]
+
+
+    def freeze(self):
+        """
+        This method turns the table into a read-only table which is
+        used for inference:
+        -> the lower orders (contexts of 1..N-1 characters) are added.
+        -> the spare capacity of the count array is released.
+        -> the count array is marked as non-writeable.
+        -> the best tag of every context is computed once. Ties are
+           broken by the order of self.STATES (the first tag wins), so
+           the same counts always give the same model.
+        -> the contexts are encoded into integer keys, then the table is
+           made compact (see _compact()).
+        Since nothing is modified after that, lookups never allocate
+        anything and the table can be shared safely across threads.
+        """
+        if self.frozen:
+            return
+        self._add_lower_orders()
+        self._counts = np.array(self.counts, dtype=COUNT_DTYPE)
+        self._counts.flags.writeable = False
+        self.transitions.flags.writeable = False
+        self.best = self._best_tags()
+        self._build_keys()
+        self.frozen = True
+
+
+    def thaw(self):
+        """This method turns a frozen table back into a trainable one"""
+        if not self.frozen:
+            return
+        #only the counted contexts are kept, freeze() adds the lower orders again
+        top = self._top_rows()
+        contexts = self.contexts
+        self._contexts = [contexts[row_id] for row_id in top.tolist()]
+        self._index = {context: idx for idx, context in enumerate(self._contexts)}
+        self._counts = np.array(self._count_rows(top), dtype=COUNT_DTYPE)
+        self._sparse = self._points = None
+        self.transitions = np.array(self.transitions, dtype=COUNT_DTYPE)
+        self.best = None
+        self.vocab = self.keys = self.key_backoff = self._char_codes = self._weights = None
+        self.frozen = False
+
+
+    def _top_rows(self):
+        """the row ids of the contexts of N characters (the counted ones)"""
+        return np.flatnonzero(self._orders() == self.N)
+
+
+    def _orders(self):
+        """the number of characters of the context of every row"""
+        if self._contexts is None:
+            return np.count_nonzero(self._padded_points(), axis=1)
+        return np.fromiter(map(len, self._contexts), dtype=np.intp, count=len(self._contexts))
+
+
+    def _parents(self):
+        """the row id of every context without its first character (-1 for single characters)"""
+        if self._keyed:
+            #zero the first character of every context, then find the keys
+            points = np.array(self._padded_points())
+            orders = np.count_nonzero(points, axis=1)
+            points[np.arange(len(points)), self.N-orders] = 0
+            parents = self.keys.searchsorted(self._point_keys(points, self.vocab)).astype(np.intp)
+            parents[orders == 1] = -1
+            return parents
+        index = self.index
+        return np.array([index.get(context[1:], -1) for context in self.contexts], dtype=np.intp)
+
+
+    def _add_lower_orders(self):
+        """
+        add the contexts of N-1 characters down to one character, the counts
+        of a context are the sum of the counts of all the longer contexts
+        that end with it (every character is counted once per order)
+        """
+        rows = self._top_rows()
+        for _ in range(self.N-1):
+            contexts = self.contexts
+            suffixes = np.array([self.intern(contexts[row_id][1:]) for row_id in rows.tolist()], dtype=np.intp)
+            self._reserve(len(self))
+            np.add.at(self._counts, suffixes, self._counts[rows])
+            rows = np.unique(suffixes)
+
+
+    def prior(self):
+        """the probability of every tag (how often it was seen out of all the tags)"""
+        counts = self._count_rows(np.flatnonzero(self._orders() == 1)).sum(axis=0, dtype=np.float64)
+        if counts.sum() == 0:
+            return np.full(len(self.STATES), 1./len(self.STATES))
+        return counts / counts.sum()
+
+
+    def probabilities(self):
+        """
+        This method returns a (contexts x states) array of the probability
+        of every tag given every context using Witten-Bell interpolation:
+            P(t | c) = l * count(c, t) / count(c) + (1 - l) * P(t | c')
+        where c' is the context c without its first character (the prior
+        for single characters) and l = count(c) / (count(c) + number of
+        distinct tags seen after c). So, contexts seen a few times rely
+        more on their shorter endings. It's computed when needed (in
+        freeze() and by the decoders) and it's not kept.
+        """
+        counts = np.asarray(self.counts, dtype=np.float32)
+        totals = counts.sum(axis=1)
+        distinct = np.count_nonzero(counts, axis=1)
+        weights = np.divide(totals, totals + distinct, out=np.zeros_like(totals), where=totals > 0)
+        counts /= np.maximum(totals, 1)[:, None] #maximum likelihood
+        orders = self._orders()
+        parents = self._parents() if self.N > 1 else None
+        prior = self.prior().astype(np.float32)
+        probabilities = counts #computed in place, one order at a time
+        for order in range(1, self.N+1):
+            rows = np.flatnonzero(orders == order)
+            lower = prior if order == 1 else probabilities[parents[rows]]
+            probabilities[rows] = (weights[rows, None] * counts[rows] +
+                                   (1 - weights[rows, None]) * lower)
+        return probabilities
+
+
+    def _best_tags(self):
+        """the id of the most probable tag of every row (-1 for an empty table)"""
+        if self.counts.sum() == 0:
+            return np.full(len(self), -1, dtype=np.int8)
+        return self.probabilities().argmax(axis=1).astype(np.int8)
+
+
+    def _backoff_table(self, best):
+        """
+        the (contexts x N) array of the best tag ids of all the endings of
+        every context: [row, k-1] is the best tag of its last k characters
+        (-1 when the context is shorter than k characters)
+        """
+        backoff = np.full((len(self), self.N), -1, dtype=np.int8)
+        orders = self._orders()
+        parents = self._parents()
+        rows = np.arange(len(self))
+        current = rows.copy()
+        for step in range(self.N):
+            seen = current >= 0
+            backoff[rows[seen], orders[seen]-1-step] = best[current[seen]]
+            current[seen] = parents[current[seen]]
+        return backoff
+
+
+    def _padded_points(self):
+        """the (contexts x N) code points of the contexts, shorter ones are padded with zeros"""
+        #read before the contexts, another thread may be building them (see _materialize())
+        points = self._points
+        if points is not None:
+            return points
+        if self._contexts is None:
+            return self._key_points()
+        text = ''.join([context.rjust(self.N, '\0') for context in self.contexts])
+        return np.frombuffer(text.encode('utf-32-le'), dtype='<u4').reshape(len(self), self.N)
+
+
+    def _key_points(self):
+        """the padded code points of the contexts decoded out of their keys"""
+        keys = np.asarray(self.keys)
+        codes = np.empty((len(keys), self.N), dtype=np.int64)
+        for col in range(self.N):
+            #the first character is the least significant
+            keys, codes[:, col] = np.divmod(keys, self.radix)
+        points = np.zeros(codes.shape, dtype='<u4')
+        known = codes >= FIRST_CODE
+        points[known] = self.vocab[codes[known] - FIRST_CODE]
+        return points
+
+
+    def _point_keys(self, points, vocab):
+        """the integer keys of padded contexts (None if they don't fit into 64 bits)"""
+        radix = len(vocab) + FIRST_CODE
+        if radix ** self.N >= 2**63:
+            return None
+        codes = np.searchsorted(vocab, points).astype(np.int64) + FIRST_CODE
+        codes[points == 0] = 0 #padding
+        keys = np.zeros(len(points), dtype=np.int64)
+        for col in range(self.N-1, -1, -1):
+            #the last character is the most significant
+            keys = keys*radix + codes[:, col]
+        return keys
+
+
+    def _build_keys(self):
+        """build the sorted integer keys of the contexts, then make the table compact"""
+        points = self._padded_points()
+        vocab = np.unique(points)
+        self.vocab = vocab[vocab != 0]
+        self.radix = len(self.vocab) + FIRST_CODE
+        keys = self._point_keys(points, self.vocab)
+        if keys is None:
+            #contexts can't be encoded into 64-bit integers
+            self.vocab = self.keys = self.key_backoff = None
+            return
+        order = np.argsort(keys, kind='stable')
+        key_backoff = self._backoff_table(self.best)[order]
+        self._compact(order)
+        self.keys = keys[order]
+        self.key_backoff = key_backoff
+        self._build_char_codes()
+
+
+    def _compact(self, order):
+        """
+        sort the rows in the given order (the order of their keys) and drop
+        the strings. The counts are kept as sparse rows: the non-zero counts
+        of row r are values[starts[r]:starts[r+1]] and their tag ids are
+        tag_ids[starts[r]:starts[r+1]] (most contexts have a few tags only).
+        """
+        counts = self.counts[order]
+        rows, tag_ids = np.nonzero(counts)
+        starts = np.zeros(len(counts)+1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(counts)), out=starts[1:])
+        self._sparse = (starts, tag_ids.astype(np.int8), counts[rows, tag_ids])
+        self._counts = np.zeros((0, len(self.STATES)), dtype=COUNT_DTYPE)
+        self.best = self.best[order]
+        self._contexts = self._index = None
+
+
+    def _build_char_codes(self):
+        """
+        build the character -> code dictionary of the vocabulary (it's tiny)
+        and the weights of the digits of a key (the last character first)
+        """
+        self._char_codes = {chr(point): FIRST_CODE+idx for idx, point in enumerate(self.vocab.tolist())}
+        self._weights = [self.radix ** col for col in range(self.N-1, -1, -1)]
+
+
+    def encode(self, points):
+        """
+        This method takes an array of unicode code points and returns
+        their codes in the vocabulary (UNKNOWN_CODE for unseen characters)
+        """
+        if len(self.vocab) == 0:
+            return np.full(len(points), UNKNOWN_CODE, dtype=np.int64)
+        codes = np.searchsorted(self.vocab, points).astype(np.int64)
+        codes[codes == len(self.vocab)] = 0
+        known = self.vocab[codes] == points
+        codes += FIRST_CODE
+        codes[~known] = UNKNOWN_CODE
+        return codes
+
+
+    def context_keys(self, codes, positions, start_code=None):
+        """
+        This method takes the codes of the characters of many words put
+        one after the other and the position of each character in its word.
+        Then, it returns the integer key of the context of every character
+        (the N-1 characters before it and the character itself). Characters
+        before the beginning of a word are replaced by 'start_code'.
+        """
+        weight = self.radix ** (self.N-1)
+        keys = codes * weight
+        for k in range(1, self.N):
+            weight //= self.radix
+            previous = np.empty_like(codes)
+            previous[k:] = codes[:-k]
+            previous[positions < k] = start_code if start_code is not None else 0
+            keys += previous * weight
+        return keys
+
+
+    def best_tag_ids(self, keys, with_orders=False):
+        """
+        This method is the vectorized version of backoff_tag(), it takes
+        an array of context keys (see context_keys()) and returns the best
+        tag id of the longest seen ending of each one of them (-1 when even
+        the last character was never seen).
+        Since the last character is the most significant digit of a key,
+        contexts that end the same way are next to each other in self.keys.
+        So, the longest seen ending of a context is shared with one of its
+        two neighbours in self.keys and just one binary search is needed
+        (whatever the number of orders backed off).
+        If 'with_orders' is True, the number of characters of the ending
+        that was used is returned too (0 for unseen characters, N when the
+        whole context was seen).
+        """
+        if len(self.keys) == 0:
+            tag_ids = np.full(len(keys), -1, dtype=np.int8)
+            return (tag_ids, np.zeros(len(keys), dtype=np.intp)) if with_orders else tag_ids
+        found = np.searchsorted(self.keys, keys)
+        left = np.maximum(found-1, 0)
+        right = np.minimum(found, len(self.keys)-1)
+        left_common = self._common_orders(keys, self.keys[left])
+        right_common = self._common_orders(keys, self.keys[right])
+        neighbours = np.where(left_common > right_common, left, right)
+        common = np.maximum(left_common, right_common)
+        tag_ids = self.key_backoff[neighbours, np.maximum(common-1, 0)]
+        tag_ids = np.where(common > 0, tag_ids, -1).astype(np.int8)
+        return (tag_ids, common) if with_orders else tag_ids
+
+
+    def word_best_tag_ids(self, word, start, with_orders=False):
+        """
+        This method is the version of context_keys() then best_tag_ids()
+        for one word (the characters before it are 'start') and it returns
+        lists. For one word, every NumPy call costs more than the lookups,
+        so the keys are computed in Python and found using one binary
+        search. Only the unseen contexts look at their neighbours (see
+        best_tag_ids()). The table must have keys.
+        """
+        word_keys, found = self._word_keys(word, start)
+        if found is None:
+            return ([-1]*len(word_keys), [0]*len(word_keys)) if with_orders else [-1]*len(word_keys)
+        tag_ids = self.best[found].tolist()
+        orders = [self.N] * len(word_keys)
+        for idx, found_key in enumerate(self.keys[found].tolist()):
+            if found_key != word_keys[idx]:
+                neighbour, orders[idx] = self._neighbour(word_keys[idx], int(found[idx]))
+                tag_ids[idx] = int(self.key_backoff[neighbour, orders[idx]-1]) if orders[idx] else -1
+        return (tag_ids, orders) if with_orders else tag_ids
+
+
+    def word_backoff_ids(self, word, start):
+        """
+        This method does the same as backoff_id() (with_order=True) for the
+        contexts of all the characters of a word (the characters before it
+        are 'start') and returns two lists: the row ids and the orders. It
+        works like word_best_tag_ids().
+        """
+        word_keys, found = self._word_keys(word, start)
+        if found is None:
+            return [-1]*len(word_keys), [0]*len(word_keys)
+        row_ids = found.tolist()
+        orders = [self.N] * len(word_keys)
+        for idx, found_key in enumerate(self.keys[found].tolist()):
+            if found_key != word_keys[idx]:
+                _, orders[idx] = self._neighbour(word_keys[idx], row_ids[idx])
+                #the key of the ending: the other characters are zeros
+                weight = self.radix ** (self.N-orders[idx])
+                row_ids[idx] = int(self.keys.searchsorted(word_keys[idx] // weight * weight)) if orders[idx] else -1
+        return row_ids, orders
+
+
+    def _word_keys(self, word, start):
+        """
+        the keys of the contexts of a word (a list) and the row id of the
+        last key <= each one of them (-1 if there's none) or None if there
+        are no keys to look at
+        """
+        radix, weight = self.radix, self.radix ** (self.N-1)
+        codes = self._char_codes
+        #the key before the first character: N-1 start characters
+        key = codes.get(start, UNKNOWN_CODE) * radix * (weight-1) // (radix-1)
+        word_keys = []
+        for char in word:
+            #drop the first character and add the new one as the last
+            key = key // radix + codes.get(char, UNKNOWN_CODE) * weight
+            word_keys.append(key)
+        if not word_keys or not len(self.keys):
+            return word_keys, None
+        return word_keys, self.keys.searchsorted(word_keys, side='right') - 1
+
+
+    def _neighbour(self, key, row_id):
+        """
+        the neighbour of an unseen key (row_id is the last key before it)
+        that shares the most last characters with it and how many they are
+        """
+        best_common, neighbour = 0, -1
+        first = max(row_id, 0)
+        for other_id, other in enumerate(self.keys[first:row_id+2].tolist(), first):
+            #the common last characters are the common top digits
+            common = 0
+            for weight in self._weights:
+                if key // weight != other // weight:
+                    break
+                common += 1
+            if common > best_common:
+                best_common, neighbour = common, other_id
+        return neighbour, best_common
+
+
+    def _common_orders(self, keys, other_keys):
+        """the number of last characters that two arrays of keys share"""
+        common = np.zeros(len(keys), dtype=np.intp)
+        weight = self.radix ** self.N
+        for _ in range(self.N):
+            weight //= self.radix
+            common += (keys // weight) == (other_keys // weight)
+        return common
+
+
+    def get(self, context, tag):
+        """This method returns the count of a certain (context, tag) pair"""
+        row_id = self._find_row(context)
+        col_id = self.state_index.get(tag)
+        if row_id < 0 or col_id is None:
+            return 0
+        return int(self._count_rows([row_id])[0, col_id])
+
+
+    def items(self):
+        """
+        This method iterates over the non-zero entries of the table
+        and yields ((context, tag), count) just like the old dictionary.
+        Only the contexts of N characters are there (the lower orders
+        are computed out of them).
+        """
+        top = self._top_rows()
+        contexts = self.contexts
+        counts = self._count_rows(top)
+        for idx, col_id in zip(*np.nonzero(counts)):
+            yield (contexts[top[idx]], self.STATES[col_id]), int(counts[idx, col_id])
+
+
+    def iter_rows(self, chunk_size=1<<16, all_orders=False):
+        """
+        This method iterates over the contexts of N characters (or the
+        contexts of all orders if 'all_orders' is True) sorted by their
+        characters in chunks of 'chunk_size' contexts. It yields tuples of:
+        -> contexts: a list of strings.
+        -> counts: the (len(contexts) x states) count array of them.
+        -> best: the best tag id of every context (None if not frozen).
+        A memory-mapped table is read one chunk at a time, so the whole
+        model is never built in memory.
+        """
+        points = self._padded_points()
+        rows = np.arange(len(self)) if all_orders else self._top_rows()
+        #shorter contexts are padded with zeros, so they come first
+        rows = rows[np.lexsort(np.asarray(points[rows]).T[::-1])] if len(rows) else rows
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start+chunk_size]
+            contexts = self._point_contexts(points[chunk])
+            best = np.asarray(self.best[chunk]) if self.best is not None else None
+            yield contexts, self._count_rows(chunk), best
+
+
+    def _reserve(self, num_rows):
+        """grow the count array (by doubling) to hold at least 'num_rows' rows"""
+        capacity = self._counts.shape[0]
+        if num_rows <= capacity:
+            return
+        new_capacity = max(num_rows, 2*capacity, 1024)
+        grown = np.zeros((new_capacity, len(self.STATES)), dtype=COUNT_DTYPE)
+        grown[:capacity] = self._counts
+        self._counts = grown
+
+
+    def __getstate__(self):
+        #don't pickle the index nor the spare capacity, they are rebuilt.
+        #The lower orders and the best tags are saved (when frozen) so they
+        #aren't recomputed.
+        return {'N': self.N, 'STATES': self.STATES, 'NULL_TAG': self.NULL_TAG,
+                'sources': self.sources, 'contexts': self.contexts, 'counts': np.ascontiguousarray(self.counts),
+                'transitions': self.transitions, 'best': self.best, 'lower_orders': self.frozen}
+
+
+    def __setstate__(self, state):
+        self.N = state['N']
+        self.STATES = tuple(state['STATES'])
+        self.state_index = {tag: idx for idx, tag in enumerate(self.STATES)}
+        self.NULL_TAG = state.get('NULL_TAG', 'O')
+        self._lock = threading.Lock()
+        self.sources = state.get('sources', {})
+        self._contexts = list(state['contexts'])
+        self._index = {context: idx for idx, context in enumerate(self._contexts)}
+        self._points = self._sparse = None
+        self._counts = np.array(state['counts'], dtype=COUNT_DTYPE)
+        self.transitions = np.zeros((len(self.STATES)+1, len(self.STATES)), dtype=COUNT_DTYPE)
+        if state.get('transitions') is not None:
+            self.transitions = np.array(state['transitions'], dtype=COUNT_DTYPE)
+        self.frozen = False
+        self.best = None
+        self.vocab = self.keys = self.key_backoff = self._char_codes = self._weights = None
+        if state.get('best') is not None and not state.get('lower_orders'):
+            #saved frozen before the lower orders were kept, so freeze it again
+            self.freeze()
+        elif state.get('best') is not None:
+            #saved while frozen, so restore it frozen
+            self._counts.flags.writeable = False
+            self.transitions.flags.writeable = False
+            self.best = np.asarray(state['best'], dtype=np.int8)
+            self._build_keys()
+            self.frozen = True
+
+
+    def save_binary(self, path):
+        """
+        This method saves the table in a binary format that can be loaded
+        using memory-mapping (see load_binary()). The file contains:
+        -> BINARY_MAGIC, the format version and the length of the header.
+        -> a JSON header with N, the states, the null tag, the sources and
+           where each of the following arrays is found in the file.
+        -> vocab: the sorted code points of all characters.
+        -> points: the code points of the contexts of all orders (sorted by
+           their last character first), one row each. Contexts shorter than
+           N characters are padded with zeros at the beginning.
+        -> counts: the (contexts x states) count array.
+        -> best: the id of the best tag of every context.
+        -> backoff: the (contexts x N) best tag ids of all the endings of
+           every context (see best_tag_ids()).
+        -> transitions: the (states+1 x states) transition counts.
+        -> keys: the (sorted) integer key of every context, it's left out
+           if the contexts can't be encoded into 64-bit integers.
+        All arrays are little-endian and start at multiples of BINARY_ALIGNMENT.
+        The file is replaced atomically, so processes that have the old
+        file memory-mapped keep reading the old model.
+        The table must be frozen.
+        """
+        assert self.frozen, "Only frozen tables can be saved, call freeze() first."
+        points = self._padded_points()
+        #sort the contexts, this is the same order as their integer keys
+        order = np.lexsort(points.T) if len(self) else np.zeros(0, dtype=np.intp)
+        vocab = np.unique(points)
+        arrays = {'vocab': vocab[vocab != 0].astype('<u4'),
+                  'points': points[order],
+                  'counts': self.counts[order].astype('<u4'),
+                  'best': self.best[order].astype(np.int8),
+                  'backoff': self._backoff_table(self.best)[order],
+                  'transitions': self.transitions.astype('<u4')}
+        radix = len(arrays['vocab']) + FIRST_CODE
+        keys = self._point_keys(arrays['points'], arrays['vocab'])
+        if keys is not None:
+            arrays['keys'] = keys.astype('<i8')
+
+        header = {'N': self.N, 'STATES': self.STATES, 'NULL_TAG': self.NULL_TAG,
+                  'radix': radix, 'sources': self.sources, 'sections': {}}
+        offset = 0 #from the beginning of the data (just after the header)
+        for name, array in arrays.items():
+            header['sections'][name] = {'offset': offset, 'dtype': array.dtype.str,
+                                        'shape': list(array.shape)}
+            offset = _align(offset + array.nbytes)
+        encoded_header = json.dumps(header).encode()
+        #the file may be memory-mapped by other processes (or by this table),
+        #so it's never rewritten in place: a new file is written next to it
+        #then it replaces the old one (which stays there for the mappings)
+        temp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(temp_path, 'wb') as fout:
+                fout.write(BINARY_MAGIC)
+                fout.write(np.array([BINARY_VERSION, len(encoded_header)], dtype='<u4').tobytes())
+                fout.write(encoded_header)
+                data_start = _align(fout.tell())
+                for name, array in arrays.items():
+                    #pad till the beginning of the array
+                    fout.write(b'\0' * (data_start + header['sections'][name]['offset'] - fout.tell()))
+                    fout.write(np.ascontiguousarray(array).tobytes())
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+    @classmethod
+    def load_binary(cls, path, mmap=True):
+        """
+        This method loads a table saved by save_binary(). When 'mmap' is
+        True, the arrays aren't read but memory-mapped, so loading is
+        almost instant and processes using the same file share the
+        same memory (the page cache).
+        The loaded table is frozen. Files of the first version (which had
+        no lower orders) are read into memory and frozen again.
+        """
+        with open(path, 'rb') as fin:
+            assert fin.read(len(BINARY_MAGIC)) == BINARY_MAGIC, "Not a binary model: %s" % path
+            version, header_length = np.frombuffer(fin.read(8), dtype='<u4')
+            assert version <= BINARY_VERSION, "Unsupported model version: %d" % version
+            header = json.loads(fin.read(header_length).decode())
+            data_start = _align(fin.tell())
+
+        def section(name):
+            info = header['sections'][name]
+            shape = tuple(info['shape'])
+            if not mmap or 0 in shape:
+                count = int(np.prod(shape))
+                return np.fromfile(path, dtype=info['dtype'], count=count,
+                                   offset=data_start+info['offset']).reshape(shape)
+            return np.memmap(path, dtype=info['dtype'], mode='r',
+                             offset=data_start+info['offset'], shape=shape)
+
+        table = cls(header['N'], header['STATES'], header['NULL_TAG'])
+        table.sources = header.get('sources', {})
+        if 'transitions' in header['sections']:
+            #loaded into memory since it's tiny
+            table.transitions = np.array(section('transitions'), dtype=COUNT_DTYPE)
+        if version < 2:
+            text = np.ascontiguousarray(section('points')).tobytes().decode('utf-32-le')
+            table._contexts = [text[idx:idx+table.N] for idx in range(0, len(text), table.N)]
+            table._index = {context: idx for idx, context in enumerate(table._contexts)}
+            table._counts = np.array(section('counts'), dtype=COUNT_DTYPE)
+            table.freeze()
+            return table
+        table._contexts = table._index = None #built when needed (without keys)
+        table._points = section('points')
+        table._counts = section('counts')
+        table.best = section('best')
+        table.vocab = section('vocab')
+        table.radix = header['radix']
+        table.transitions.flags.writeable = False
+        if 'keys' in header['sections']:
+            table.keys = section('keys')
+            table.key_backoff = section('backoff')
+            table._build_char_codes()
+        table.frozen = True
+        return table
+
+
+    @classmethod
+    def from_dict(cls, d, n, states, null_tag='O'):
+        """
+        This method converts a model saved in the old format (a dictionary
+        whose keys are ((*context, char), tag) and values are counts)
+        into an NgramTable.
+        Keys whose tag is not in 'states' are dropped since the model
+        can never predict them anyway.
+        """
+        table = cls(n, states, null_tag)
+        rows, cols, counts = [], [], []
+        for (context, tag), count in d.items():
+            col_id = table.state_index.get(tag)
+            if col_id is None or count == 0:
+                continue
+            rows.append(table.intern(''.join(context)))
+            cols.append(col_id)
+            counts.append(count)
+        table.add(rows, cols, np.asarray(counts, dtype=COUNT_DTYPE))
+        return table
+
+
+    def to_dict(self):
+        """
+        This method converts the table back into the old format. So, it
+        returns a dictionary whose keys are ((*context, char), tag) and
+        whose values are (float) counts.
+        """
+        return {(tuple(context), tag): float(count) for (context, tag), count in self.items()}
+
+
+
+def _align(offset):
+    """round the given offset up to a multiple of BINARY_ALIGNMENT"""
+    return -(-offset // BINARY_ALIGNMENT) * BINARY_ALIGNMENT
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 import re
 import os
-import subprocess
+import multiprocessing
+import random
+import argparse
+import itertools
 from glob import glob
 from xml.etree import ElementTree as ET
 from utils import *
@@ -9,15 +12,23 @@ from utils import *
 
 
 
+#for removing numbers and punctuations except [., !, ؟]
+NOISE_REGEX = re.compile(r'([\d\\/\(\)\[\]\|\-’÷×*+_<>«»@#$%^&:]+)')
+#sentences end with [., !, ؟]
+SENTENCE_END_REGEX = re.compile(r'؟|!|\.+')
+#size of the chunks read from the data files (in characters)
+CHUNK_SIZE = 1 << 20
+
+
+
 class Preprocessor():
     def __init__(self):
-        self.VOWEL_REGEX = re.compile('|'.join(['ُ', 'َ', 'ِ', 'ْ']))
-        #for removing numbers and punctuations except [., !, ؟]
-        self.NOISE_REGEX = r'([\d\\/\(\)\[\]\|\-’÷×*+_<>«»@#$%^&:]+)'
-        self.out_dir = 'preprocessed'
+        self.VOWEL_REGEX = SHORT_VOWEL_REGEX
+        self.NOISE_REGEX = NOISE_REGEX
+        self.out_dir = PREPROCESSED_DIR
         create_dir(self.out_dir) #create directory if it wasn't existed
 
-    def preprocess(self, data_dir):
+    def preprocess(self, data_dir, workers=1, words_per_file=10**6):
         """
         This method takes a path to the data as an input, then it does
         two things actually:
@@ -27,12 +38,16 @@ class Preprocessor():
            directory (self.out_dir) where each word in the sentence is
            written in a seperate line. These sentences are seperated by
            a newline character (\n). Each file should contain roughly one
-           million words in it.
+           million words in it ('words_per_file').
+        The input files are preprocessed by 'workers' processes, each file
+        is read in chunks and written into a temporary part file. Then,
+        the part files are joined in order into the output files, so the
+        output is the same whatever the number of workers is.
         This function returns nothing.
         """
         # the first ** means every file and dir under 'diacritized_text'
         # the second * means every file in every directory
-        files = glob(os.path.join(data_dir, '**', '*'), recursive=True)
+        files = sorted(glob(os.path.join(data_dir, '**', '*'), recursive=True))
         # We have around 397 files divided as:
         # -> 97 files from 'http://www.al-islam.com'
         # -> 2 files from 'aljazeera'
@@ -43,44 +58,43 @@ class Preprocessor():
         # -> 56 files from 'diwanalarab'
         # -> 20 files from 'mohamed bn abdel-wahab'
         # -> 8 directories
-        outFiles_count = 1
+        files = [filename for filename in files if not os.path.isdir(filename)]
+        parts_dir = os.path.join(self.out_dir, '.parts')
+        create_dir(parts_dir)
+        jobs = [(filename, os.path.join(parts_dir, str(idx))) for idx, filename in enumerate(files)]
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+        outFiles_count = 0
         word_count = 0
-        outFile = open(os.path.join(self.out_dir, str(outFiles_count)), 'wb')
-        for filename in files:
-            #if filename is a directory
-            if os.path.isdir(filename):
-                continue
-            #if filename is an xml file
-            elif filename[:-4] == ".xml":
-                tree = ET.parse(filename)
-                content = "\n".join([node.text for node in tree.findall('.//text/body/p')])
-            #otherwise
-            else:
-                with open(filename, 'rb') as fout:
-                    print(filename)
-                    content = fout.read().decode() #convert text from bytes into string
-            for sentence in re.split(r'؟|!|\.+', content):
-                sentence = re.sub(self.NOISE_REGEX, '', sentence) #remove numbers and punctuations
-                sentence = sentence.strip() #remove whitespaces at the end
-
-                INSIDE = False #to make sure it found a diacritized word
-                for word in re.split(r'\s+', sentence):
-                    #make sure that the sentence is diacritized
-                    if re.search(self.VOWEL_REGEX, word):
-                        INSIDE = True
-                        outFile.write(word.encode()+'\n'.encode())
-                        word_count += 1
-                if INSIDE:
-                    outFile.write('\n'.encode())
-                if word_count >= 10**6:
-                    outFile.close()
-                    word_count = 0
-                    outFiles_count += 1
-                    outFile = open(os.path.join(self.out_dir, str(outFiles_count)), 'wb')
-            print("DONE:", word_count)
-
-
-    def split(self, ratio=0.2):
+        outFile = None
+        try:
+            results = pool.imap(preprocess_file, jobs) if pool else map(preprocess_file, jobs)
+            for (filename, part_path), num_words in zip(jobs, results):
+                print(filename)
+                with open(part_path, 'rb') as fin:
+                    for line in fin:
+                        if outFile is None:
+                            outFiles_count += 1
+                            outFile = open(os.path.join(self.out_dir, str(outFiles_count)), 'wb')
+                        outFile.write(line)
+                        if line != b'\n':
+                            word_count += 1
+                        elif word_count >= words_per_file:
+                            #end of a sentence
+                            outFile.close()
+                            outFile = None
+                            word_count = 0
+                os.remove(part_path)
+                print("DONE:", num_words)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            if outFile is not None:
+                outFile.close()
+        os.rmdir(parts_dir)
+
+
+    def split(self, ratio=0.2, seed=None, link=False):
         """
         This method takes a train-test ratio as an input (20% default value)
         then, it splits the preprocessed data into two directories (train, test)
@@ -88,54 +102,146 @@ class Preprocessor():
         then we would have two directories:
         -> train with 70 files in it.. [1, 2, 3, ... 70]
         -> test with 30 files in it ..[71, 72, ... 100]
+        If 'seed' is given, the files are shuffled (using this seed) before
+        being split, so the same seed always gives the same split.
+        The files are moved (no data is copied) or hard-linked if 'link' is
+        True, which keeps the preprocessed files where they are.
         """
         assert 0 <= ratio <= 1, 'Invalid Number for ratio'
         ratio = 1. - ratio
-        num_files = len(os.listdir(self.out_dir))
+        #the preprocessed files are named 1, 2, 3, ...
+        filenames = sorted([filename for filename in os.listdir(self.out_dir) if filename.isdigit()], key=int)
+        num_files = len(filenames)
         if num_files > 0:
             train_dir = os.path.join(self.out_dir, 'train')
             create_dir(train_dir)
-            test_dir = os.path.join(self.out_dir, 'test')
-            create_dir(test_dir)
             test_dir = os.path.join(self.out_dir, 'test', 'gold')
             create_dir(test_dir)
+            if seed is not None:
+                random.Random(seed).shuffle(filenames)
             n = int(num_files*(ratio))
+            move = os.link if link else os.replace
             #move train files
-            # os.system('mv apple/1 apple/train',)
-            # subprocess.call(["ls", "-t", "-v", train_dir, "1"])
-            # os.system( 'mv -t -v %s 1 2 3' % )
+            for filename in filenames[:n]:
+                move(os.path.join(self.out_dir, filename), os.path.join(train_dir, filename))
             #move test files
-            # os.system( 'mv -t -v %s '+' '.join(range(n+1, num_files+1)) %test_dir)
+            for filename in filenames[n:]:
+                move(os.path.join(self.out_dir, filename), os.path.join(test_dir, filename))
 
-    def remove_diacritization(self):
+    def remove_diacritization(self, workers=1):
         """This method aims at removing any diacritization from
         the test files, then write the cleaned version into
         another directory.
         We read from the 'gold' directory and write the cleaned
         version into 'test'
+        The files are cleaned using 'workers' processes, each file is
+        streamed in chunks (see remove_file_diacritization()).
         """
         gold_dir = os.path.join(self.out_dir, 'test', 'gold')
         create_dir(gold_dir)
         test_dir = os.path.join(self.out_dir, 'test', 'test')
         create_dir(test_dir)
-        for in_filename in os.listdir(gold_dir):
-            print('FILE:', in_filename)
-            out_filename = os.path.join(test_dir, in_filename)
-            in_filename = os.path.join(gold_dir, in_filename)
-            with open(in_filename, 'rb') as fin:
-                with open(out_filename, 'wb') as fout:
-                    for word in fin.readlines():
-                        word = word.decode()
-                        cleaned = clean_word(word)
-                        fout.write(cleaned.encode())
+        jobs = [(os.path.join(gold_dir, filename), os.path.join(test_dir, filename))
+                for filename in sorted(os.listdir(gold_dir))]
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+        try:
+            results = pool.imap(remove_file_diacritization, jobs) if pool else map(remove_file_diacritization, jobs)
+            for (in_filename, _), _ in zip(jobs, results):
+                print('FILE:', os.path.basename(in_filename))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def prepare(self, data_dir, ratio=0.2, seed=None, workers=1):
+        """
+        This method runs the whole data preparation at once:
+        preprocess(), split() then remove_diacritization().
+        """
+        self.preprocess(data_dir, workers=workers)
+        self.split(ratio, seed=seed)
+        self.remove_diacritization(workers=workers)
+
+
+
+
+def read_chunks(filename):
+    """
+    This function yields the text of the given data file in chunks.
+    For the XML files (sulaity), the text of every paragraph (text/body/p)
+    is yielded as a chunk (separated by newlines) while the file is parsed
+    incrementally, so the whole tree is never held in memory.
+    """
+    if filename.endswith('.xml'):
+        tags = [] #the tags from the root to the current element
+        first = True
+        for event, elem in ET.iterparse(filename, events=('start', 'end')):
+            tag = elem.tag.rsplit('}', 1)[-1] #remove the namespace
+            if event == 'start':
+                tags.append(tag)
+                continue
+            if tags[-3:] == ['text', 'body', 'p']:
+                yield ('' if first else '\n') + (elem.text or '')
+                first = False
+                elem.clear()
+            tags.pop()
+    else:
+        with open_text(filename) as fin:
+            for chunk in iter(lambda: fin.read(CHUNK_SIZE), ''):
+                yield chunk
+
+
+def preprocess_file(job):
+    """
+    This function preprocesses one data file (see Preprocessor.preprocess()).
+    It takes a tuple of (filename, out_filename) and writes the diacritized
+    sentences of this file into 'out_filename' (each word in a line and
+    sentences are seperated by an empty line). It returns the number of
+    words written.
+    A sentence may be split between two chunks, so the text after the last
+    end of sentence in a chunk is kept and put before the next chunk.
+    """
+    filename, out_filename = job
+    word_count = 0
+    rest = ''
+    with open_text(out_filename, 'w') as fout:
+        for chunk in itertools.chain(read_chunks(filename), [None]):
+            if chunk is None: #end of file, the rest is the last sentence
+                sentences, rest = [rest], ''
+            else:
+                #remove numbers and punctuations
+                sentences = SENTENCE_END_REGEX.split(rest + NOISE_REGEX.sub('', chunk))
+                rest = sentences.pop()
+            for sentence in sentences:
+                #make sure that the sentence is diacritized
+                words = [word for word in sentence.split() if SHORT_VOWEL_REGEX.search(word)]
+                if words:
+                    fout.write('\n'.join(words) + '\n\n')
+                    word_count += len(words)
+    return word_count
+
 
-            
+def remove_file_diacritization(job):
+    """
+    This function takes a tuple of (in_filename, out_filename) and writes
+    the content of 'in_filename' without any diacritization into
+    'out_filename'. The file is read in chunks and the diacritics are
+    deleted using str.translate() (see clean_word()).
+    """
+    in_filename, out_filename = job
+    with open_text(in_filename) as fin, open_text(out_filename, 'w') as fout:
+        for chunk in iter(lambda: fin.read(CHUNK_SIZE), ''):
+            fout.write(chunk.translate(DIACRITICS_TABLE))
 
 
 
 
 if __name__ == "__main__":
-    p = Preprocessor()
-    # p.preprocess('./diacritized_text')
-    # p.split(0.2)
-    p.remove_diacritization()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Prepare the Tashkeela data: preprocess it, "
+                                     "split it into train/test and remove the diacritization of the test data.")
+    parser.add_argument('data_dir', help="directory of the diacritized text")
+    parser.add_argument('--ratio', type=float, default=0.2, help="ratio of the test files")
+    parser.add_argument('--seed', type=int, default=None, help="shuffle the files using this seed before splitting")
+    parser.add_argument('--workers', type=int, default=1, help="number of processes")
+    args = parser.parse_args()
+    Preprocessor().prepare(args.data_dir, args.ratio, args.seed, args.workers)
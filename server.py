@@ -0,0 +1,375 @@
+import sys
+import json
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from hmm import HMM, DECODERS
+from metrics import Metrics
+from utils import *
+
+
+
+DEFAULT_PORT = 8765
+#the longest request (one line of JSON) in bytes
+MAX_LINE = 1 << 20
+
+_worker_model = None #the model of a worker process (see _init_worker())
+
+
+
+def _init_worker(model_path, decoder, beam_size):
+    """load the model once in every worker process"""
+    global _worker_model
+    _worker_model = HMM.load(model_path, decoder=decoder, beam_size=beam_size)
+
+
+def _diacritize_in_worker(texts):
+    return _worker_model.diacritize_texts(texts)
+
+
+
+class MicroBatcher(object):
+    def __init__(self, diacritize, executor, max_batch_size=64, max_delay=0.002,
+                 max_queue=4096, concurrency=1, metrics=None):
+        """
+        This class coalesces concurrent requests into batches. The first
+        request waits at most 'max_delay' seconds for others to join it
+        and a batch has at most 'max_batch_size' requests. Then, the whole
+        batch is diacritized at once by 'diacritize' (a function that takes
+        a list of texts and returns them diacritized) which is run inside
+        'executor' (a thread or process pool), so the event loop is never
+        blocked by the CPU work.
+        -> max_queue: the number of requests waiting for a batch. When it's
+           full, new requests wait (so, the connections stop being read)
+           which is how overloading is pushed back to the clients.
+        -> concurrency: the number of batches run at the same time (the
+           number of workers of the executor).
+        """
+        self.diacritize_texts = diacritize
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        self.metrics = metrics or Metrics()
+        self._concurrency = concurrency
+        self._queue = None #created inside the event loop (see start())
+        self._slots = None
+        self._task = None
+
+
+    def start(self):
+        """starts batching the requests (it must be called inside the event loop)"""
+        self._queue = asyncio.Queue(self.max_queue)
+        self._slots = asyncio.Semaphore(self._concurrency)
+        self._task = asyncio.ensure_future(self._run())
+
+
+    async def stop(self):
+        """stops batching, the requests that are still waiting are cancelled"""
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            future.cancel()
+
+
+    async def diacritize(self, text, timeout=None):
+        """
+        This method diacritizes one text (along with the other requests of
+        its batch) and returns it. It raises asyncio.TimeoutError if it
+        takes more than 'timeout' seconds (waiting time included).
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.metrics.count('server.requests')
+        try:
+            return await asyncio.wait_for(self._submit(text, future), timeout)
+        except asyncio.TimeoutError:
+            self.metrics.count('server.timeouts')
+            future.cancel()
+            raise
+
+
+    async def _submit(self, text, future):
+        await self._queue.put((text, future))
+        return await future
+
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._slots.acquire()
+            asyncio.ensure_future(self._run_batch(batch))
+
+
+    async def _run_batch(self, batch):
+        try:
+            #requests that timed out while waiting are dropped
+            batch = [(text, future) for text, future in batch if not future.done()]
+            if not batch:
+                return
+            self.metrics.count('server.batches')
+            self.metrics.count('server.batched_requests', len(batch))
+            texts = [text for text, _ in batch]
+            loop = asyncio.get_running_loop()
+            try:
+                with self.metrics.timer('server.batch'):
+                    results = await loop.run_in_executor(self.executor, self.diacritize_texts, texts)
+            except Exception as error:
+                self.metrics.count('server.errors')
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                return
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._slots.release()
+
+
+
+class DiacritizationServer(object):
+    def __init__(self, batcher, request_timeout=5., max_pending=1024):
+        """
+        This class serves a MicroBatcher over a stream (a TCP or a unix
+        socket). The protocol is one JSON object per line (UTF-8):
+        -> request: {"text": "...", "id": ...} where "id" is optional.
+        -> response: {"text": "...", "id": ...} or {"error": "...", "id": ...}
+        Requests of the same connection are handled concurrently (so they
+        can join the same batch) and their responses are written in the
+        same order. At most 'max_pending' requests of a connection are
+        handled at once, then the connection isn't read until some of
+        them are answered.
+        The diacritics of the given texts are removed before diacritizing them.
+        """
+        self.batcher = batcher
+        self.request_timeout = request_timeout
+        self.max_pending = max_pending
+
+
+    async def handle(self, reader, writer):
+        """handles one connection (used by asyncio.start_server())"""
+        responses = asyncio.Queue(self.max_pending)
+        writer_task = asyncio.ensure_future(self._write_responses(responses, writer))
+        try:
+            while not writer_task.done():
+                try:
+                    line = await reader.readline()
+                except (ValueError, ConnectionError): #too long line or closed connection
+                    break
+                if not line:
+                    break
+                await responses.put(asyncio.ensure_future(self._respond(line)))
+            await responses.put(None)
+            await writer_task
+        except asyncio.CancelledError:
+            #the server is shutting down
+            writer_task.cancel()
+        finally:
+            writer.close()
+
+
+    async def _respond(self, line):
+        try:
+            request = json.loads(line)
+            text = request['text']
+            assert isinstance(text, str)
+        except (ValueError, KeyError, TypeError, AssertionError):
+            return {'error': 'expecting a JSON object with a "text" string'}
+        response = {'id': request['id']} if 'id' in request else {}
+        try:
+            response['text'] = await self.batcher.diacritize(clean_word(text), self.request_timeout)
+        except asyncio.TimeoutError:
+            response['error'] = 'timeout'
+        except Exception as error:
+            response['error'] = '%s: %s' % (type(error).__name__, error)
+        return response
+
+
+    async def _write_responses(self, responses, writer):
+        """write the responses in the order of their requests"""
+        while True:
+            task = await responses.get()
+            if task is None:
+                return
+            response = await task
+            try:
+                writer.write((json.dumps(response, ensure_ascii=False) + '\n').encode())
+                await writer.drain()
+            except ConnectionError:
+                #the client has gone, forget about the rest
+                while task is not None:
+                    task.cancel()
+                    task = await responses.get()
+                return
+
+
+
+class Client(object):
+    def __init__(self, reader, writer):
+        """
+        This class is a client of DiacritizationServer, use connect() to
+        create it. Many requests can be sent concurrently over the same
+        connection:
+        >>> client = await Client.connect(port=8765)
+        >>> await asyncio.gather(*[client.diacritize(text) for text in texts])
+        """
+        self._reader = reader
+        self._writer = writer
+        self._pending = {} #id -> future of the response
+        self._next_id = 0
+        self._task = asyncio.ensure_future(self._read_responses())
+
+
+    @classmethod
+    async def connect(cls, host='127.0.0.1', port=DEFAULT_PORT, path=None):
+        """connects to a server at (host, port) or at the unix socket 'path'"""
+        if path:
+            reader, writer = await asyncio.open_unix_connection(path, limit=MAX_LINE)
+        else:
+            reader, writer = await asyncio.open_connection(host, port, limit=MAX_LINE)
+        return cls(reader, writer)
+
+
+    async def diacritize(self, text):
+        """sends a text and returns it diacritized (raises RuntimeError on errors)"""
+        request_id = self._next_id
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        self._writer.write((json.dumps({'id': request_id, 'text': text}, ensure_ascii=False) + '\n').encode())
+        await self._writer.drain()
+        response = await future
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response['text']
+
+
+    async def _read_responses(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                future = self._pending.pop(response.get('id'), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("The connection was closed."))
+
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+        self._task.cancel()
+
+
+
+async def serve(model_path, host='127.0.0.1', port=DEFAULT_PORT, path=None, processes=0,
+                max_batch_size=64, max_delay=0.002, max_queue=4096, request_timeout=5.,
+                decoder='greedy', beam_size=4):
+    """
+    This function loads the model saved at 'model_path' once and serves it
+    at (host, port) or at the unix socket 'path' till it's cancelled.
+    Batches are diacritized in a thread, or in 'processes' worker processes
+    (each one loads the model, binary models are memory-mapped so they
+    share the same memory). See MicroBatcher for the other arguments.
+    """
+    metrics = Metrics()
+    if processes > 0:
+        executor = ProcessPoolExecutor(processes, initializer=_init_worker,
+                                       initargs=(model_path, decoder, beam_size))
+        diacritize = _diacritize_in_worker
+    else:
+        model = HMM.load(model_path, decoder=decoder, beam_size=beam_size, metrics=metrics)
+        executor = ThreadPoolExecutor(1)
+        diacritize = model.diacritize_texts
+    batcher = MicroBatcher(diacritize, executor, max_batch_size, max_delay, max_queue,
+                           concurrency=max(processes, 1), metrics=metrics)
+    batcher.start()
+    server = DiacritizationServer(batcher, request_timeout)
+    if path:
+        listener = await asyncio.start_unix_server(server.handle, path, limit=MAX_LINE)
+    else:
+        listener = await asyncio.start_server(server.handle, host, port, limit=MAX_LINE)
+    print('Serving on', path or '%s:%d' % (host, port), file=sys.stderr)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        await batcher.stop()
+        executor.shutdown(wait=False)
+
+
+async def diacritize_lines(lines, host='127.0.0.1', port=DEFAULT_PORT, path=None, concurrency=64):
+    """
+    This function sends 'lines' to a server keeping 'concurrency' requests
+    in flight and returns them diacritized (in the same order).
+    """
+    client = await Client.connect(host, port, path)
+    semaphore = asyncio.Semaphore(concurrency)
+    async def diacritize(line):
+        async with semaphore:
+            return await client.diacritize(line)
+    try:
+        return await asyncio.gather(*[diacritize(line) for line in lines])
+    finally:
+        await client.close()
+
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a trained model (or send it text) over a socket.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help="load a model and serve it")
+    serve_parser.add_argument('model', help="path of the trained model (pickle or binary)")
+    serve_parser.add_argument('--processes', type=int, default=0, help="worker processes (0 uses a thread)")
+    serve_parser.add_argument('--max-batch-size', type=int, default=64, help="requests per batch")
+    serve_parser.add_argument('--max-delay', type=float, default=2., help="milliseconds a request waits for a batch")
+    serve_parser.add_argument('--max-queue', type=int, default=4096, help="requests waiting for a batch")
+    serve_parser.add_argument('--timeout', type=float, default=5., help="seconds before a request fails")
+    serve_parser.add_argument('--decoder', choices=DECODERS, default='greedy')
+    serve_parser.add_argument('--beam-size', type=int, default=4)
+    client_parser = commands.add_parser('client', help="diacritize stdin (one text per line) using a server")
+    client_parser.add_argument('--concurrency', type=int, default=64, help="requests in flight")
+    for command_parser in [serve_parser, client_parser]:
+        command_parser.add_argument('--host', default='127.0.0.1')
+        command_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+        command_parser.add_argument('--unix', help="path of a unix socket (instead of host:port)")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        try:
+            asyncio.run(serve(args.model, args.host, args.port, args.unix, args.processes,
+                              args.max_batch_size, args.max_delay/1000., args.max_queue, args.timeout,
+                              args.decoder, args.beam_size))
+        except KeyboardInterrupt:
+            pass
+    else:
+        with open_text('-') as fin:
+            lines = [line.rstrip('\n') for line in fin]
+        outputs = asyncio.run(diacritize_lines(lines, args.host, args.port, args.unix, args.concurrency))
+        with open_text('-', 'w') as fout:
+            for line in outputs:
+                fout.write(line + '\n')
@@ -1,8 +1,14 @@
+import io
 import os
 import re
+import sys
+import hashlib
+import itertools
+import threading
 import numpy as np
 import _pickle as pickle
-import matplotlib.pyplot as plt
+from collections import OrderedDict
+from contextlib import contextmanager
 
 
 #Global Variables
@@ -11,6 +17,15 @@ OTHER = 'O'
 #double damma, double fatha, double kasera, damma, fatha, kasera, sukoon, shadd
 VOWEL_SYMBOLS = {'ٌ', 'ً', 'ٍ', 'ُ', 'َ', 'ِ', 'ْ', 'ٌّ', 'ّ'}
 VOWEL_REGEX = re.compile('|'.join(VOWEL_SYMBOLS))
+#a character followed by its vowel symbols (only the first two are its tag)
+VOWEL_CHARS = ''.join(sorted(symbol for symbol in VOWEL_SYMBOLS if len(symbol) == 1))
+TOKEN_REGEX = re.compile('([^%s])([%s]{0,2})[%s]*' % ((VOWEL_CHARS,)*3))
+#translation table that deletes all the vowel symbols (see clean_word())
+DIACRITICS_TABLE = str.maketrans('', '', VOWEL_CHARS)
+#short vowels: damma, fatha, kasera, sukoon (a word having any of them is diacritized)
+SHORT_VOWEL_REGEX = re.compile('|'.join(['ُ', 'َ', 'ِ', 'ْ']))
+#where the preprocessed data is saved
+PREPROCESSED_DIR = 'preprocessed'
 
 
 
@@ -30,6 +45,41 @@ def word_iterator(word):
     As we can see, the symbol O stands for OTHER and it means that the character
     doesn't have an associated vowel symbol
     """
+    if len(word) < 2:
+        #a single character has no tag
+        return []
+    return [(char, vowels or OTHER) for char, vowels in TOKEN_REGEX.findall(word)]
+
+
+def split_word(word, tag_index=None):
+    """
+    This function does the same as word_iterator() but it returns the
+    characters (as a string) and their tags (as a list) separately:
+    >>> split_word('مُقَدِّمَةُ')
+    ('مقدمة', ['ُ', 'َ', 'ِّ', 'َ', 'ُ'])
+    If 'tag_index' (a dictionary: tag -> id) is given, the ids of the
+    tags are returned instead (-1 for tags that aren't in 'tag_index').
+    The word is split in just one pass (using TOKEN_REGEX), every
+    character takes the first two vowel symbols after it as a tag and
+    vowel symbols with no character before them are ignored.
+    """
+    if len(word) < 2:
+        #a single character has no tag
+        return '', []
+    tokens = TOKEN_REGEX.findall(word)
+    chars = ''.join([char for char, _ in tokens])
+    if tag_index is None:
+        tags = [vowels or OTHER for _, vowels in tokens]
+    else:
+        tags = [tag_index.get(vowels or OTHER, -1) for _, vowels in tokens]
+    return chars, tags
+
+
+def _word_iterator_reference(word):
+    """
+    The original (slower) implementation of word_iterator(), it's kept
+    to check that both of them give the same output (see __main__).
+    """
     output = []
     prev_char = word[0]
     for idx, char in enumerate(word[1:]):
@@ -56,6 +106,65 @@ def word_iterator(word):
     return output
 
 
+
+class LRUCache(object):
+    def __init__(self, maxsize=10000):
+        """
+        This class is a bounded (Least Recently Used) cache. When it's full,
+        the least recently used item is evicted to make room for the new one.
+        It counts the hits, misses and evictions and it can be used safely
+        from many threads. A 'maxsize' of 0 disables the cache.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+    def get(self, key, default=None):
+        """returns the cached value of 'key' (or 'default' if not cached)"""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+
+    def put(self, key, value):
+        """caches the given value, evicting the least recently used one if full"""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+
+    def clear(self):
+        """removes all the cached items (the counters are kept)"""
+        with self._lock:
+            self._data.clear()
+
+
+    def info(self):
+        """returns the counters of the cache as a dictionary"""
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size': len(self._data), 'maxsize': self.maxsize}
+
+
+
 def create_dir(name):
     """
     This function takes a string as an input. 
@@ -69,6 +178,67 @@ def create_dir(name):
         os.makedirs(name)
 
 
+def file_checksum(filename, chunk_size=1<<20):
+    """
+    This function returns the SHA-1 checksum (as a hex string) of the
+    content of the given file. The file is read in chunks.
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+@contextmanager
+def open_text(path, mode='r', buffering=1<<20):
+    """
+    This function opens a UTF-8 text file for reading ('r') or writing ('w')
+    using a big buffer. 'path' can be:
+    -> a path of a file.
+    -> '-' which stands for stdin (when reading) or stdout (when writing).
+    -> an already opened text file, which is used as it is.
+    Lines are separated by '\n' only. It's used as a context manager:
+    >>> with open_text('-', 'w') as fout:
+            fout.write('مُقَدِّمَةُ\n')
+    """
+    if hasattr(path, 'read') or hasattr(path, 'write'):
+        yield path
+    elif path == '-':
+        std = sys.stdin if mode == 'r' else sys.stdout
+        stream = io.TextIOWrapper(std.buffer, encoding='utf-8', newline='\n')
+        try:
+            yield stream
+        finally:
+            if mode != 'r':
+                stream.flush()
+            stream.detach() #don't close stdin/stdout
+    else:
+        with open(path, mode, buffering=buffering, encoding='utf-8', newline='\n') as stream:
+            yield stream
+
+
+def iter_sentences(fin, max_length=None):
+    """
+    This function takes an opened file where each word is written in a
+    separate line and sentences are separated by an empty line (the format
+    of the preprocessed data). It yields one sentence at a time as a list
+    of (stripped) lines including the empty line that ends the sentence.
+    So, writing these lines back (each followed by '\n') gives the same file.
+    If 'max_length' is given, longer sentences are yielded in parts of
+    'max_length' lines (a file with no empty lines isn't read whole).
+    """
+    sentence = []
+    for line in fin:
+        line = line.strip()
+        sentence.append(line)
+        if line == '' or len(sentence) == max_length:
+            yield sentence
+            sentence = []
+    if sentence: #last sentence with no empty line after it
+        yield sentence
+
+
 def clean_word(word):
     """
     This function takes a word (discrentized or not) as an input and returns 
@@ -80,7 +250,7 @@ def clean_word(word):
     >>> type(x)
     'str'
     """
-    return re.sub(VOWEL_REGEX, '', word)
+    return word.translate(DIACRITICS_TABLE)
 
 def evaluate_word(gold_word, predicted_word, analysis=False):
     """
@@ -95,8 +265,8 @@ def evaluate_word(gold_word, predicted_word, analysis=False):
     """
     correct = 0.     #number of correct tags
     total_num = 0.   #total count of tags
-    gold_tags = [tag for _, tag in word_iterator(gold_word)]
-    predicted_tags = [tag for _, tag in word_iterator(predicted_word)]
+    _, gold_tags = split_word(gold_word)
+    _, predicted_tags = split_word(predicted_word)
     assert len(gold_tags) == len(predicted_tags)
     for gold_tag, predicted_tag in zip(gold_tags, predicted_tags):
         total_num += 1
@@ -117,6 +287,8 @@ def draw_histogram(d, filename=None):
     False (default value) and it saves the figure as an image if it
     was set to True.
     """
+    #imported here since it's slow to import and only needed for plotting
+    import matplotlib.pyplot as plt
     labels, values = zip(*d.items())
     indexes = np.arange(len(labels))
 
@@ -130,45 +302,52 @@ def draw_histogram(d, filename=None):
 
 
 
-def turn_pickle_to_text(pickle_file, text_file):
+def turn_pickle_to_text(pickle_file, text_file, chunk_size=1<<16):
     """
     This function turns the model (as a pickle file) into
     text file to be ready for being parsed in Java.
-    The input pickle_file is a dictionary where:
-    key: is a tuple and character.
+    The pickle file is either a dictionary (the old format) where:
+    key: is a tuple of (context characters, tag).
     value: is a count
+    or an NgramTable (whose items() are the same). Every line of the text
+    file is the characters of the context (any number of them) and the tag
+    separated by '|' then a tab and the count. The lines are written in
+    chunks of 'chunk_size'. See export.py for sorted TSV and SQLite exports
+    which can be loaded back.
     """
     with open(pickle_file, "rb") as fin:
         d = pickle.load(fin)
 
-    with open(text_file, "wb") as fout:
-        for k, v in d.items():
-            s = k[0][0]+'|'+k[0][1]+'|'+k[0][2]+'|'+k[1]+'\t'+str(v)
-            fout.write(s.encode())
-            fout.write('\n'.encode())
+    with open_text(text_file, 'w') as fout:
+        items = iter(d.items())
+        while True:
+            chunk = ['|'.join(context)+'|'+tag+'\t'+str(count)+'\n'
+                     for (context, tag), count in itertools.islice(items, chunk_size)]
+            if not chunk:
+                break
+            fout.write(''.join(chunk))
 
 
 
 
 
 if __name__ == "__main__":
-    word = 'مُقَدِّمَةُ'
-    print(clean_word(word))
-    # turn_pickle_to_text('3gram_CharModel.pickle', 'E:\\Career\\Courses\\Data Science\\Natural Language Processing (NLP)\\PROJECTS\\Tashkeela\\untitled\\src\\test.txt')
-    # words = ['مُقَدِّمَةُ', 'الطَّبَرِيِّ', 'شَيْخِ', 'الدِّينِ', 'فَجَاءَ', 'فِيهِ', 'بِالْعَجَبِ', 'الْعُجَابِ', 'وَنَثَرَ', 'فِيهِ', 'أَلْبَابَ', 'الْأَلْبَاب']
-    print(evaluate_word('الْأَلْبَاب', clean_word('الْأَلْبَاب')))
-    print(evaluate_word('مُقَدِّمَةُ', clean_word('مُقَدِّمَةُ')))
-    
-    # N = 3
-    # for word in words:
-    #     print(clean_word(word))
-    #     print(word)
-    #     ################
-    #     charsonly, tagsonly = zip(*[('*', 'O')]*(N-1)+word_iterator(word))
-    #     print(charsonly)
-    #     print(tagsonly)
-    #     for char, tag in zip(charsonly, tagsonly):
-    #         print(char, tag)
-    #     #####################
-    #     # for t in word_iterator(word):
-    #     #     print(t)
\ No newline at end of file
+    import timeit
+    #check that word_iterator() gives the same output as the original
+    #implementation for every word (up to 5 characters) made of two
+    #letters and all the vowel symbols (so, all the tags)
+    alphabet = ['م', 'ق'] + list(VOWEL_CHARS)
+    num_words = 0
+    for length in range(6):
+        for word in itertools.product(alphabet, repeat=length):
+            word = ''.join(word)
+            if word:
+                assert word_iterator(word) == _word_iterator_reference(word), word
+            num_words += 1
+    print("word_iterator() is equivalent to the original on %d words" % num_words)
+
+    #micro-benchmark
+    words = ['مُقَدِّمَةُ', 'الطَّبَرِيِّ', 'شَيْخِ', 'الدِّينِ', 'فَجَاءَ', 'فِيهِ', 'بِالْعَجَبِ', 'الْعُجَابِ', 'وَنَثَرَ', 'فِيهِ', 'أَلْبَابَ', 'الْأَلْبَاب']
+    for func in [_word_iterator_reference, word_iterator, split_word]:
+        seconds = min(timeit.repeat(lambda: [func(word) for word in words], number=10000, repeat=3))
+        print("%-26s %.0f words/sec" % (func.__name__, 10000*len(words)/seconds))